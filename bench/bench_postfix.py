@@ -0,0 +1,228 @@
+#!/usr/bin/python3
+
+# bench_postfix.py - Benchmark check_postfix.py on synthetic mail logs
+#
+# Licensed under the GNU GPLv3
+
+"""Benchmark check_postfix.py on synthetic mail logs of increasing size.
+
+For every size a log (with rotation chain) is generated by genmaillog.py
+and every mode is run in a fresh interpreter, which reports wall time,
+bytes read, lines per second and peak RSS. The counts are cross-checked
+against a naive reference parser.
+
+Variants with --statefile or --indexfile are run twice, with a cold and
+a warm file. The state file keeps day and week by minute, so these are
+compared with the counts of whole minutes.
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import gzip
+import json
+import lzma
+import os
+import re
+import resource
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import genmaillog
+
+FRAMES = {'minute': timedelta(minutes=1),
+          'hour':   timedelta(hours=1),
+          'day':    timedelta(days=1),
+          'week':   timedelta(days=7)}
+COUNTERS = ('sent', 'received', 'greylisted', 'rejected')
+
+def referenceChain(logfile):
+    # Yield all files of the rotation chain, oldest first
+    chain = [logfile]
+    n = 1
+    while True:
+        for suffix in ('', '.gz', '.xz'):
+            path = '{}.{}{}'.format(logfile, n, suffix)
+            if os.path.isfile(path):
+                chain.append(path)
+                break
+        else:
+            break
+        n += 1
+    return reversed(chain)
+
+def referenceCounts(logfile, now):
+    """Count every time frame the slow and obvious way: decode every line,
+    parse its timestamp with strptime and classify it with the original
+    four regular expressions of check_postfix.py. The counts are returned
+    exactly and from the start of the minute of every time frame on."""
+    starts = {frame: now - delta for (frame, delta) in FRAMES.items()}
+    counts = {frame: [0, 0, 0, 0] for frame in FRAMES}
+    aligned = {frame: [0, 0, 0, 0] for frame in FRAMES}
+    lines = {frame: 0 for frame in FRAMES}
+    for path in referenceChain(logfile):
+        if path.endswith('.gz'):
+            f = gzip.open(path, 'rt')
+        elif path.endswith('.xz'):
+            f = lzma.open(path, 'rt')
+        else:
+            f = open(path)
+        for line in f:
+            t = datetime.strptime('{} {}'.format(now.year, line[0:15]),
+                                  '%Y %b %d %H:%M:%S')
+            if t.month > now.month:
+                t = t.replace(year=now.year - 1)
+            if re.search(" postfix/smtp.* to.*, status=sent", line):
+                idx = 0
+            elif re.search(" postfix/pipe.* to.*, relay=dovecot, .*, status=sent", line):
+                idx = 1
+            elif re.search(" postfix/smtpd.* NOQUEUE: reject:.* rejected:", line):
+                idx = 2 if re.search("Greylisted", line) else 3
+            else:
+                idx = None
+            for frame in FRAMES:
+                if t >= starts[frame]:
+                    lines[frame] += 1
+                    if idx is not None:
+                        counts[frame][idx] += 1
+                if idx is not None and \
+                        t >= starts[frame].replace(second=0):
+                    aligned[frame][idx] += 1
+        f.close()
+    return (counts, aligned, lines)
+
+def measure(logfile, mode, now, options):
+    """Run a single check in this (fresh) interpreter and print wall time,
+    bytes read, peak RSS and counts as JSON."""
+    import check_postfix
+
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--jobs', type=int, default=1)
+    argp.add_argument('--statefile')
+    argp.add_argument('--indexfile')
+    opts = argp.parse_args(options)
+
+    postfix = check_postfix.Postfix(logfile, mode, statefile=opts.statefile,
+            indexfile=opts.indexfile, jobs=opts.jobs)
+    postfix.now = now
+    postfix.t_now = postfix.toStamp(now)
+    rchar = readIo()
+    t_start = time.perf_counter()
+    metrics = postfix.probe()
+    wall = time.perf_counter() - t_start
+    print(json.dumps({
+        'wall': wall,
+        'read': readIo() - rchar,
+        'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'metrics': {metric.name: metric.value for metric in metrics}}))
+
+def readIo():
+    # Return bytes read by this process so far
+    with open('/proc/self/io') as f:
+        for line in f:
+            if line.startswith('rchar:'):
+                return int(line.split()[1])
+    return 0
+
+def runMeasure(logfile, mode, now, options):
+    cmd = [sys.executable, os.path.abspath(__file__), '--measure',
+           logfile, mode, now.strftime('%Y-%m-%dT%H:%M:%S')] + options
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+def compare(mode, metrics, reference, aligned=None):
+    # Return True if the counts of a run equal the reference counts, day
+    # and week are compared with the aligned counts if given
+    frames = list(FRAMES) if mode == 'all' else [mode]
+    for frame in frames:
+        counts = reference[frame]
+        if aligned is not None and frame in ('day', 'week'):
+            counts = aligned[frame]
+        for (idx, name) in enumerate(COUNTERS):
+            if mode == 'all':
+                name = '{}_{}'.format(name, frame)
+            if metrics[name] != counts[idx]:
+                return False
+    return True
+
+def main():
+    argp = argparse.ArgumentParser(description=__doc__)
+    argp.add_argument('-w', '--workdir', metavar='DIR',
+                default='/tmp/bench_postfix',
+                help='directory for generated logs (default: \
+                      /tmp/bench_postfix)')
+    argp.add_argument('-s', '--sizes', metavar='SIZES',
+                default='100M,1G,10G',
+                help='comma separated log sizes (default: 100M,1G,10G)')
+    argp.add_argument('-m', '--modes', metavar='MODES',
+                default='minute,hour,day,week,all',
+                help='comma separated modes (default: all of them)')
+    argp.add_argument('-z', '--compress', choices=('none', 'gz', 'xz'),
+                default='gz', help='compression of rotated logs (default: gz)')
+    argp.add_argument('-o', '--option', metavar='OPTIONS', action='append',
+                help='check_postfix options of a variant to benchmark, e.g. \
+                      "--jobs 4" or "--statefile" (the file is placed in \
+                      --workdir), repeatable (default: no options)')
+    argp.add_argument('-n', '--no-verify', action='store_true',
+                help='skip the cross-check against the reference parser')
+    argp.add_argument('--measure', nargs=argparse.REMAINDER,
+                help=argparse.SUPPRESS)
+    args = argp.parse_args()
+
+    if args.measure:
+        (logfile, mode, now) = args.measure[0:3]
+        measure(logfile, mode, datetime.strptime(now, '%Y-%m-%dT%H:%M:%S'),
+                args.measure[3:])
+        return
+
+    variants = [option.split() for option in (args.option or [''])]
+    now = datetime.now().replace(microsecond=0)
+    print('{:>6} {:>7} {:<26} {:<5} {:>9} {:>10} {:>11} {:>9} {}'.format(
+          'size', 'mode', 'options', 'cache', 'wall [s]', 'read [MB]',
+          'lines/s', 'RSS [MB]', 'counts'))
+    for size in args.sizes.split(','):
+        directory = os.path.join(args.workdir, size)
+        logfile = os.path.join(directory, 'mail.log')
+        genmaillog.generate(directory, now, 9,
+                genmaillog.parseSize(size) / 165 / (9 * 86400),
+                genmaillog.parseMix('sent=2,received=2,greylisted=1,'
+                                    'rejected=1,other=10'),
+                args.compress, 0)
+        if not args.no_verify:
+            (reference, aligned, lines) = referenceCounts(logfile, now)
+        for mode in args.modes.split(','):
+            for (variant, options) in enumerate(variants):
+                label = ' '.join(options)
+                runs = ['-']
+                for (option, suffix) in (('--statefile', 'state'),
+                                         ('--indexfile', 'index')):
+                    if option not in options:
+                        continue
+                    path = os.path.join(args.workdir, '{}-{}-{}.{}'.format(
+                            size, mode, variant, suffix))
+                    if os.path.exists(path):
+                        os.unlink(path)
+                    idx = options.index(option)
+                    options = options[:idx + 1] + [path] + options[idx + 1:]
+                    runs = ['cold', 'warm']
+                for run in runs:
+                    result = runMeasure(logfile, mode, now, options)
+                    if args.no_verify:
+                        (rate, verdict) = ('-', '-')
+                    else:
+                        frame = 'week' if mode == 'all' else mode
+                        rate = '{:.0f}'.format(lines[frame] / result['wall'])
+                        verdict = 'ok' if compare(mode, result['metrics'],
+                                reference, aligned if '--statefile' in
+                                options else None) else 'MISMATCH'
+                    print('{:>6} {:>7} {:<26} {:<5} {:>9.3f} {:>10.1f} {:>11} {:>9.1f} {}'.format(
+                          size, mode, label, run, result['wall'],
+                          result['read'] / 1024 ** 2, rate,
+                          result['rss'] / 1024 ** 2, verdict), flush=True)
+
+if __name__ == '__main__':
+    main()
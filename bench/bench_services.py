@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+
+# bench_services.py - Benchmark the networked checks against local stand-ins
+#
+# Licensed under the GNU GPLv3
+
+"""Benchmark check_etherpad.py, check_ethercalc.py and check_prosody.py.
+
+For every service and scale a stand-in from fakeservices.py is started
+and every mode is probed in a fresh interpreter, which reports wall time
+and peak RSS. The stand-in counts the requests and knows the metrics the
+check has to report, so the results are cross-checked as well.
+
+Variants with --cachefile are run twice, with a cold and a warm cache,
+and --churn percent of the pads or rooms are modified in between.
+Variants with "--source openmetrics" query the /metrics endpoint of the
+Prosody stand-in.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import fakeservices
+
+# Modes benchmarked per service, the Etherpad check has a single one
+MODES = {'etherpad':  ('age', ),
+         'ethercalc': ('count', 'all'),
+         'prosody':   ('c2s', 'uptime', 'presence')}
+# Check options supported per service
+OPTIONS = {'etherpad':  ('--concurrency', '--cachefile'),
+           'ethercalc': ('--concurrency', '--cachefile'),
+           'prosody':   ('--source', )}
+
+def measure(service, port, mode, options):
+    """Probe a single check in this (fresh) interpreter and print wall
+    time, peak RSS and metrics as JSON."""
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--concurrency', type=int, default=8)
+    argp.add_argument('--cachefile')
+    argp.add_argument('--source', default='console')
+    argp.add_argument('--url')
+    opts = argp.parse_args(options)
+
+    if service == 'etherpad':
+        import check_etherpad
+        check = check_etherpad.EtherPad(host='127.0.0.1', port=port,
+                apikey='bench', concurrency=opts.concurrency,
+                cachefile=opts.cachefile)
+    elif service == 'ethercalc':
+        import check_ethercalc
+        check = check_ethercalc.EtherCalc(host='127.0.0.1', port=port,
+                mode=mode, concurrency=opts.concurrency,
+                cachefile=opts.cachefile)
+    else:
+        import check_prosody
+        check = check_prosody.Prosody(host='127.0.0.1', port=port, mode=mode,
+                timeout=600, source=opts.source, url=opts.url)
+    t_start = time.perf_counter()
+    metrics = check.probe()
+    wall = time.perf_counter() - t_start
+    print(json.dumps({
+        'wall': wall,
+        'rss': peakRss(),
+        'metrics': {metric.name: metric.value for metric in metrics}}))
+
+def peakRss():
+    # Return the peak RSS of this process. Unlike ru_maxrss it isn't
+    # inherited from the parent, which holds the data of the stand-ins.
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def runMeasure(service, port, mode, options):
+    cmd = [sys.executable, os.path.abspath(__file__), '--measure',
+           service, str(port), mode] + options
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+def compare(metrics, expected):
+    # Return True if all metrics the stand-in knows are as expected, the
+    # uptime from OpenMetrics is computed from the current time
+    for (name, value) in metrics.items():
+        if name in expected and abs(value - expected[name]) > 1e-6:
+            return False
+    return True
+
+def main():
+    argp = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    argp.add_argument('-w', '--workdir', metavar='DIR',
+                default='/tmp/bench_services',
+                help='directory for cache files (default: \
+                      /tmp/bench_services)')
+    argp.add_argument('-S', '--services', metavar='SERVICES',
+                default='etherpad,ethercalc,prosody',
+                help='comma separated services (default: all of them)')
+    argp.add_argument('-s', '--scales', metavar='SCALES',
+                default='1k,10k,100k',
+                help='comma separated numbers of pads, rooms or client \
+                      sessions (default: 1k,10k,100k)')
+    argp.add_argument('-l', '--latency', metavar='SECONDS', type=float,
+                default=0.001,
+                help='delay of every reply of the stand-ins (default: \
+                      0.001)')
+    argp.add_argument('-c', '--churn', metavar='PERCENT', type=float,
+                default=1.0,
+                help='percentage of pads or rooms modified between cold \
+                      and warm cache runs (default: 1)')
+    argp.add_argument('-o', '--option', metavar='OPTIONS', action='append',
+                help='check options of a variant to benchmark, e.g. \
+                      "--concurrency 32", "--cachefile" (the file is \
+                      placed in --workdir) or "--source openmetrics", \
+                      repeatable (default: no options)')
+    argp.add_argument('--seed', type=int, default=0,
+                help='seed of the stand-ins (default: 0)')
+    argp.add_argument('--measure', nargs=argparse.REMAINDER,
+                help=argparse.SUPPRESS)
+    args = argp.parse_args()
+
+    if args.measure:
+        (service, port, mode) = args.measure[0:3]
+        measure(service, int(port), mode, args.measure[3:])
+        return
+
+    os.makedirs(args.workdir, exist_ok=True)
+    variants = [option.split() for option in (args.option or [''])]
+    print('{:<9} {:>7} {:<8} {:<20} {:<5} {:>9} {:>9} {:>9} {}'.format(
+          'service', 'scale', 'mode', 'options', 'cache', 'wall [s]',
+          'requests', 'RSS [MB]', 'metrics'))
+    for service in args.services.split(','):
+        for scale in args.scales.split(','):
+            fake = fakeservices.FAKES[service](fakeservices.parseScale(scale),
+                    args.latency, args.seed)
+            port = fake.start()
+            for mode in MODES[service]:
+                for options in variants:
+                    if any(option.startswith('--') and
+                           option not in OPTIONS[service]
+                           for option in options):
+                        continue
+                    label = ' '.join(options)
+                    runs = ['-']
+                    if '--cachefile' in options:
+                        cachefile = os.path.join(args.workdir,
+                                '{}-{}-{}.cache'.format(service, scale, mode))
+                        if os.path.exists(cachefile):
+                            os.unlink(cachefile)
+                        idx = options.index('--cachefile')
+                        options = options[:idx + 1] + [cachefile] + \
+                                  options[idx + 1:]
+                        runs = ['cold', 'warm']
+                    if '--source' in options:
+                        options = options + ['--url', fake.url]
+                    for run in runs:
+                        if run == 'warm':
+                            fake.touch(int(fake.size * args.churn / 100))
+                        fake.reset()
+                        result = runMeasure(service, port, mode, options)
+                        verdict = 'ok' if compare(result['metrics'],
+                                fake.expected()) else 'MISMATCH'
+                        print('{:<9} {:>7} {:<8} {:<20} {:<5} {:>9.3f} {:>9} {:>9.1f} {}'.format(
+                              service, scale, mode, label, run,
+                              result['wall'], fake.requests,
+                              result['rss'] / 1024 ** 2, verdict),
+                              flush=True)
+            fake.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,399 @@
+#!/usr/bin/python3
+
+# fakeservices.py - Local stand-ins for Etherpad, Ethercalc and Prosody
+#
+# Licensed under the GNU GPLv3
+
+"""Serve synthetic Etherpad, Ethercalc and Prosody instances locally.
+
+* etherpad: /api/<version>/listAllPads and getLastEdited for SIZE pads
+* ethercalc: /_rooms/ and the sheets at /_/<room> (with ETags) for SIZE
+  rooms, plus a form data room for every tenth of them
+* prosody: the telnet console with SIZE client sessions in c2s:show()
+  and the same sessions at /metrics (mod_http_openmetrics)
+
+Every request (console command for Prosody) is delayed by --latency
+seconds and counted. The data is generated from --seed, so runs are
+reproducible, and each stand-in knows the metrics a check has to report.
+"""
+
+import argparse
+import http.server
+import json
+import random
+import socketserver
+import threading
+import time
+import urllib.parse
+import zlib
+
+# Presence states of the Prosody sessions
+PRESENCE_STATES = ('available', 'chat', 'away', 'xa', 'dnd')
+# Uptime reported by the Prosody console
+UPTIME = (3, 4, 30)
+
+class FakeService:
+    """Base of the stand-ins: serves in threads and counts requests."""
+
+    def __init__(self, size, latency=0.0, seed=0):
+        self.size     = size
+        self.latency  = latency
+        self.random   = random.Random(seed)
+        self.lock     = threading.Lock()
+        self.requests = 0
+        self.server   = None
+
+    def counted(self):
+        # Count a request and delay its reply
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+
+    def start(self, port=0):
+        # Serve in a background thread, returns the port
+        self.server = self.makeServer(('127.0.0.1', port))
+        self.server.service = self
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        return self.server.server_address[1]
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def touch(self, count):
+        # Modify count items, as users would between two checks
+        pass
+
+    def expected(self):
+        # Return the metrics a check has to report
+        return {}
+
+class HttpHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # replies are small, don't wait for delayed ACKs on keep-alive
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.server.service.counted()
+        url = urllib.parse.urlsplit(self.path)
+        (status, body, headers) = self.reply(urllib.parse.unquote(url.path),
+                dict(urllib.parse.parse_qsl(url.query)), self.headers)
+        self.send_response(status)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply(self, path, query, headers):
+        return self.server.service.reply(path, query, headers)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeEtherpad(FakeService):
+    """Etherpad API with pads edited within the last 400 days.
+
+    Every 50th pad was never edited (lastEdited 0), every 1000th pad ID
+    has a non-ASCII character, which is escaped in listAllPads.
+    """
+
+    def __init__(self, size, latency=0.0, seed=0):
+        super().__init__(size, latency, seed)
+        now = int(time.time() * 1000)
+        self.pads = {}
+        for i in range(size):
+            id = 'pad-{:07d}'.format(i)
+            if i % 1000 == 999:
+                id += '-ü'
+            if i % 50 == 49:
+                self.pads[id] = 0
+            else:
+                self.pads[id] = now - self.random.randint(0, 400 * 86400000)
+        # the pad IDs don't change, encode the listing once
+        self.listing = self.encode({'padIDs': list(self.pads)})
+
+    def encode(self, data):
+        return json.dumps({'code': 0, 'message': 'ok',
+                           'data': data}).encode('utf-8')
+
+    def makeServer(self, address):
+        return http.server.ThreadingHTTPServer(address, HttpHandler)
+
+    def reply(self, path, query, headers):
+        headers = {'Content-Type': 'application/json; charset=utf-8'}
+        if path.endswith('/listAllPads'):
+            return (200, self.listing, headers)
+        if path.endswith('/getLastEdited'):
+            with self.lock:
+                value = self.pads.get(query.get('padID'))
+            if value is None:
+                return (200, json.dumps({'code': 1,
+                        'message': 'padID does not exist',
+                        'data': None}).encode('utf-8'), headers)
+            return (200, self.encode({'lastEdited': value}), headers)
+        return (404, b'', {})
+
+    def touch(self, count):
+        now = int(time.time() * 1000)
+        with self.lock:
+            for id in self.random.sample(list(self.pads), count):
+                self.pads[id] = now
+
+    def expected(self):
+        with self.lock:
+            edited = [value for value in self.pads.values() if value]
+        return {'padcount': len(self.pads),
+                'padage': int(min(edited) / 1000) if edited else None}
+
+class FakeEthercalc(FakeService):
+    """Ethercalc with sheets of 1 to 200 cells.
+
+    Sheets are sent with an ETag and If-None-Match is answered with 304,
+    like Ethercalc behind a caching proxy. There's no Last-Modified.
+    """
+
+    def __init__(self, size, latency=0.0, seed=0):
+        super().__init__(size, latency, seed)
+        self.rooms = {}
+        for i in range(size):
+            room = 'room-{:07d}'.format(i)
+            self.rooms[room] = self.sheet(self.random.randint(1, 200))
+            if i % 10 == 9:
+                self.rooms[room + '_formdata'] = self.sheet(1)
+
+    def sheet(self, cells):
+        return ''.join('cell:A{}:v:{}\n'.format(row, self.random.random())
+                       for row in range(1, cells + 1)).encode('ascii')
+
+    def makeServer(self, address):
+        return http.server.ThreadingHTTPServer(address, HttpHandler)
+
+    def reply(self, path, query, headers):
+        if path == '/_rooms/':
+            with self.lock:
+                rooms = list(self.rooms)
+            return (200, json.dumps(rooms).encode('utf-8'),
+                    {'Content-Type': 'application/json'})
+        if path.startswith('/_/'):
+            with self.lock:
+                sheet = self.rooms.get(path[3:])
+            if sheet is None:
+                return (404, b'', {})
+            etag = '"{:08x}"'.format(zlib.crc32(sheet))
+            if headers.get('If-None-Match') == etag:
+                return (304, b'', {'ETag': etag})
+            return (200, sheet, {'Content-Type': 'text/plain', 'ETag': etag})
+        return (404, b'', {})
+
+    def touch(self, count):
+        with self.lock:
+            rooms = [room for room in self.rooms
+                     if not room.endswith('_formdata')]
+            for room in self.random.sample(rooms, count):
+                self.rooms[room] += self.sheet(1)
+
+    def expected(self):
+        with self.lock:
+            sheets = [sheet for (room, sheet) in self.rooms.items()
+                      if not room.endswith('_formdata')]
+        return {'roomcount': len(sheets),
+                'roomsize': sum(len(sheet) for sheet in sheets)}
+
+class ConsoleHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        service = self.server.service
+        self.wfile.write(b"Welcome to the Prosody administration console. "
+                         b"For a list of commands, type: help\n")
+        for line in self.rfile:
+            command = line.strip().decode('utf-8', 'replace')
+            if command == 'quit':
+                self.wfile.write(b"See you! :)\n")
+                return
+            service.counted()
+            self.wfile.write(service.reply(command))
+
+class ThreadingConsoleServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class MetricsHandler(HttpHandler):
+    def reply(self, path, query, headers):
+        return self.server.service.metrics(path)
+
+class FakeProsody(FakeService):
+    """Prosody console with client sessions spread over two vhosts.
+
+    Nine out of ten sessions are encrypted. c2s:show_secure(),
+    c2s:show_insecure(), c2s:show() and s2s:show() list every session
+    before their summary line, like Prosody does. The connections and
+    the start time are served at /metrics of a second (HTTP) port, too.
+    """
+
+    def __init__(self, size, latency=0.0, seed=0):
+        super().__init__(size, latency, seed)
+        self.sessions = []
+        for i in range(size):
+            host = 'example.org' if i % 4 else 'chat.example.net'
+            self.sessions.append(('user{}@{}/res{}'.format(i, host, i % 3),
+                                  host, self.random.choice(PRESENCE_STATES),
+                                  self.random.random() < 0.9))
+        self.s2s = (size // 20, size // 25)
+        # every fifth session connected over IPv6, for /metrics
+        self.families = {}
+        for (i, (jid, host, state, secure)) in enumerate(self.sessions):
+            family = (host, 'ipv6' if i % 5 == 0 else 'ipv4')
+            self.families[family] = self.families.get(family, 0) + 1
+        # replies don't change, build them once
+        self.replies = {
+            'c2s:show_secure()': self.listing(
+                    [s for s in self.sessions if s[3]],
+                    '{} secure client connections'),
+            'c2s:show_insecure()': self.listing(
+                    [s for s in self.sessions if not s[3]],
+                    '{} insecure client connections'),
+            'c2s:show()': self.listing(self.sessions, '{} clients'),
+            's2s:show()': self.s2sListing(),
+            'server:uptime()': "| This server has been running for {} "
+                    "days, {} hours and {} minutes (since Sat Oct 10 "
+                    "12:00:00 2026)\n".format(*UPTIME).encode('ascii'),
+        }
+
+    def listing(self, sessions, total):
+        lines = []
+        for host in ('chat.example.net', 'example.org'):
+            jids = [s for s in sessions if s[1] == host]
+            lines.append('| {}: {} client(s)'.format(host, len(jids)))
+            lines.extend('|    {} - {}(0)'.format(jid, state)
+                         for (jid, host, state, secure) in jids)
+        lines.append('| OK: Total: {}'.format(total.format(len(sessions))))
+        return '\n'.join(lines).encode('utf-8') + b"\n"
+
+    def s2sListing(self):
+        (outgoing, incoming) = self.s2s
+        lines = ['| example.org']
+        lines.extend('|    example.org -> remote{}.example'.format(i)
+                     for i in range(outgoing))
+        lines.extend('|    example.org <- remote{}.example'.format(i)
+                     for i in range(incoming))
+        lines.append('| OK: {} outgoing, {} incoming connections'.format(
+                     outgoing, incoming))
+        return '\n'.join(lines).encode('ascii') + b"\n"
+
+    def makeServer(self, address):
+        return ThreadingConsoleServer(address, ConsoleHandler)
+
+    def start(self, port=0):
+        # The OpenMetrics endpoint listens on any free port, see self.url
+        self.http = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                    MetricsHandler)
+        self.http.service = self
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}/metrics'.format(
+                self.http.server_address[1])
+        return super().start(port)
+
+    def stop(self):
+        self.http.shutdown()
+        self.http.server_close()
+        super().stop()
+
+    def metrics(self, path):
+        # Reply of mod_http_openmetrics: c2s connections per vhost and
+        # address family, s2s connections and the process start time,
+        # between families the check has to skip
+        if path != '/metrics':
+            return (404, b'', {})
+        lines = ['# TYPE process_cpu_seconds counter',
+                 'process_cpu_seconds_total 1234.5',
+                 '# TYPE process_start_time_seconds gauge',
+                 'process_start_time_seconds {:.3f}'.format(time.time() -
+                        ((UPTIME[0] * 24 + UPTIME[1]) * 60 + UPTIME[2]) * 60),
+                 '# TYPE prosody_mod_c2s__connections gauge']
+        for ((host, family), count) in sorted(self.families.items()):
+            lines.append('prosody_mod_c2s__connections{{host="{}",'
+                         'type="c2s",ip_family="{}"}} {}'.format(
+                         host, family, count))
+        lines += ['# TYPE prosody_mod_s2s__connections_inbound gauge',
+                  'prosody_mod_s2s__connections_inbound{{host="example.org"}}'
+                  ' {}'.format(self.s2s[1]),
+                  '# TYPE prosody_mod_s2s__connections_outbound gauge',
+                  'prosody_mod_s2s__connections_outbound{{host="example.org"}}'
+                  ' {}'.format(self.s2s[0]),
+                  '# TYPE prosody_stats_memory_lua_bytes gauge',
+                  'prosody_stats_memory_lua_bytes 2621440',
+                  '# EOF']
+        return (200, '\n'.join(lines).encode('ascii') + b'\n',
+                {'Content-Type': 'application/openmetrics-text; '
+                                 'version=1.0.0; charset=utf-8'})
+
+    def reply(self, command):
+        return self.replies.get(command,
+                b"| Error: unknown command: " + command.encode('utf-8') +
+                b"\n")
+
+    def expected(self):
+        secure = sum(1 for s in self.sessions if s[3])
+        metrics = {'c2s_secure': secure,
+                   'c2s_insecure': len(self.sessions) - secure,
+                   'c2s_all': len(self.sessions),
+                   's2s_outgoing': self.s2s[0],
+                   's2s_incoming': self.s2s[1],
+                   'uptime': UPTIME[0] + UPTIME[1] / 24 + UPTIME[2] / 60 / 24}
+        for state in PRESENCE_STATES:
+            metrics[state] = sum(1 for s in self.sessions if s[2] == state)
+        return metrics
+
+FAKES = {
+    'etherpad':  FakeEtherpad,
+    'ethercalc': FakeEthercalc,
+    'prosody':   FakeProsody,
+}
+
+def parseScale(text):
+    # Parse a count like 10000, 10k or 1M
+    units = {'k': 1000, 'm': 1000 ** 2}
+    text = text.strip().lower()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def main():
+    argp = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    argp.add_argument('service', choices=list(FAKES),
+                help='service to stand in for')
+    argp.add_argument('-p', '--port', metavar='PORT', type=int, default=0,
+                help='port to listen on (default: any free port)')
+    argp.add_argument('-n', '--size', metavar='SIZE', type=parseScale,
+                default=1000,
+                help='number of pads, rooms or client sessions, e.g. 100k \
+                      (default: 1000)')
+    argp.add_argument('-l', '--latency', metavar='SECONDS', type=float,
+                default=0.0,
+                help='delay of every reply (default: 0)')
+    argp.add_argument('--seed', type=int, default=0,
+                help='seed of the random generator (default: 0)')
+    args = argp.parse_args()
+
+    service = FAKES[args.service](args.size, args.latency, args.seed)
+    port = service.start(args.port)
+    print('{} with {} items listening on 127.0.0.1:{}'.format(args.service,
+          args.size, port), flush=True)
+    if args.service == 'prosody':
+        print('OpenMetrics at {}'.format(service.url), flush=True)
+    print(json.dumps(service.expected()), flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        service.stop()
+
+if __name__ == '__main__':
+    main()
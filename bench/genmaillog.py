@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+
+# genmaillog.py - Generate synthetic Postfix mail logs for benchmarks
+#
+# Licensed under the GNU GPLv3
+
+"""Write a synthetic, time ordered Postfix mail log with daily rotation.
+
+The newest day goes to mail.log, older days to mail.log.1, mail.log.2, ...
+which are compressed (except for mail.log.1, like logrotate's
+delaycompress) if requested.
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import gzip
+import lzma
+import os
+import random
+
+# Line templates, keyed by the counter they belong to ('other' lines are
+# postfix and non-postfix lines that aren't counted)
+TEMPLATES = {
+    'sent': [
+        '{host} postfix/smtp[{pid}]: {qid}: to=<{user}@{domain}>, '
+        'relay={relay}[{ip}]:25, delay=0.{pid}, delays=0.1/0/0.2/0.3, '
+        'dsn=2.0.0, status=sent (250 2.0.0 Ok: queued as {qid2})',
+    ],
+    'received': [
+        '{host} postfix/pipe[{pid}]: {qid}: to=<{user}@{localdomain}>, '
+        'relay=dovecot, delay=0.{pid}, delays=0.1/0/0/0.1, dsn=2.0.0, '
+        'status=sent (delivered via dovecot service)',
+    ],
+    'greylisted': [
+        '{host} postfix/smtpd[{pid}]: NOQUEUE: reject: RCPT from '
+        'unknown[{ip}]: 450 4.2.0 <{user}@{localdomain}>: Recipient address '
+        'rejected: Greylisted, see http://postgrey.schweikert.ch/help/'
+        '{localdomain}.html; from=<{user}@{domain}> to=<{user}@{localdomain}> '
+        'proto=ESMTP helo=<{relay}>',
+    ],
+    'rejected': [
+        '{host} postfix/smtpd[{pid}]: NOQUEUE: reject: RCPT from '
+        'unknown[{ip}]: 550 5.1.1 <{user}@{localdomain}>: Recipient address '
+        'rejected: User unknown in virtual mailbox table; '
+        'from=<{user}@{domain}> to=<{user}@{localdomain}> proto=ESMTP '
+        'helo=<{relay}>',
+        '{host} postfix/smtpd[{pid}]: NOQUEUE: reject: RCPT from '
+        'unknown[{ip}]: 554 5.7.1 Service unavailable; Client host [{ip}] '
+        'blocked using {rbl}; Sender address rejected: listed; '
+        'from=<{user}@{domain}> to=<{user}@{localdomain}> proto=ESMTP '
+        'helo=<{relay}>',
+    ],
+    'other': [
+        '{host} postfix/smtpd[{pid}]: connect from unknown[{ip}]',
+        '{host} postfix/smtpd[{pid}]: disconnect from unknown[{ip}] ehlo=1 '
+        'mail=1 rcpt=1 data=1 quit=1 commands=5',
+        '{host} postfix/cleanup[{pid}]: {qid}: message-id=<{qid2}@{domain}>',
+        '{host} postfix/qmgr[{pid}]: {qid}: from=<{user}@{domain}>, '
+        'size=4{pid}, nrcpt=1 (queue active)',
+        '{host} postfix/qmgr[{pid}]: {qid}: removed',
+        '{host} postfix/smtp[{pid}]: {qid}: to=<{user}@{domain}>, '
+        'relay={relay}[{ip}]:25, delay=3, dsn=4.4.1, status=deferred '
+        '(connect to {relay}[{ip}]:25: Connection timed out)',
+        '{host} dovecot: imap-login: Login: user=<{user}@{localdomain}>, '
+        'method=PLAIN, rip={ip}, lip=10.0.0.1, TLS',
+    ],
+}
+
+DOMAINS = ['example.org', 'example.com', 'mail.example.net', 'gmx.de',
+           'posteo.de', 'riseup.net', 'gmail.com', 'web.de']
+RELAYS  = ['mx1.example.org', 'mx.example.com', 'mx00.gmx.net',
+           'mx01.posteo.de', 'mx1.riseup.net', 'gmail-smtp-in.l.google.com']
+RBLS    = ['zen.spamhaus.org', 'bl.spamcop.net', 'b.barracudacentral.org']
+
+def parseMix(value):
+    # Parse 'sent=3,received=3,...' into a dict of weights
+    mix = {kind: 0 for kind in TEMPLATES}
+    for item in value.split(','):
+        (kind, weight) = item.split('=')
+        if kind not in TEMPLATES:
+            raise argparse.ArgumentTypeError('unknown line kind: ' + kind)
+        mix[kind] = float(weight)
+    return mix
+
+def parseSize(value):
+    # Parse sizes like 100M or 10G into bytes
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if value[-1:].upper() in units:
+        return int(float(value[:-1]) * units[value[-1:].upper()])
+    return int(value)
+
+def renderLine(rnd, t, kind):
+    template = rnd.choice(TEMPLATES[kind])
+    return '{} {}\n'.format(t.strftime('%b %e %H:%M:%S'), template.format(
+        host='mail', pid=rnd.randint(100, 99999),
+        qid='{:010X}'.format(rnd.getrandbits(40)),
+        qid2='{:010X}'.format(rnd.getrandbits(40)),
+        user='user{}'.format(rnd.randint(1, 5000)),
+        domain=rnd.choice(DOMAINS), localdomain='systemli.org',
+        relay=rnd.choice(RELAYS), rbl=rnd.choice(RBLS),
+        ip='{}.{}.{}.{}'.format(rnd.randint(1, 223), rnd.randint(0, 255),
+                                rnd.randint(0, 255), rnd.randint(1, 254))))
+
+def openRotated(directory, n, compress):
+    # Open the file of the n-th day before the newest one
+    if n == 0:
+        return open(os.path.join(directory, 'mail.log'), 'w')
+    path = os.path.join(directory, 'mail.log.{}'.format(n))
+    if n == 1 or compress == 'none':
+        return open(path, 'w')
+    if compress == 'gz':
+        return gzip.open(path + '.gz', 'wt')
+    return lzma.open(path + '.xz', 'wt')
+
+def generate(directory, end, days, rate, mix, compress, seed):
+    """Write `days` daily log files ending at `end` with `rate` lines per
+    second on average. Returns the total number of lines written."""
+    rnd = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    os.makedirs(directory, exist_ok=True)
+    lines = 0
+    for n in range(days - 1, -1, -1):
+        t = end - timedelta(days=n + 1)
+        t_end = end - timedelta(days=n)
+        f = openRotated(directory, n, compress)
+        while True:
+            t += timedelta(seconds=rnd.expovariate(rate))
+            if t >= t_end:
+                break
+            f.write(renderLine(rnd, t.replace(microsecond=0),
+                               rnd.choices(kinds, weights)[0]))
+            lines += 1
+        f.close()
+    return lines
+
+def main():
+    argp = argparse.ArgumentParser(description=__doc__)
+    argp.add_argument('-d', '--directory', metavar='DIR', required=True,
+                help='directory to write mail.log and rotated files to')
+    argp.add_argument('-s', '--size', metavar='SIZE', type=parseSize,
+                help='approximate total size (e.g. 100M, 1G), overrides \
+                      --rate')
+    argp.add_argument('-r', '--rate', metavar='LINES', type=float,
+                default=10.0,
+                help='average log lines per second (default: 10)')
+    argp.add_argument('-D', '--days', metavar='DAYS', type=int, default=9,
+                help='days of logs, one file per day (default: 9)')
+    argp.add_argument('-m', '--mix', metavar='MIX', type=parseMix,
+                default=parseMix('sent=2,received=2,greylisted=1,'
+                                 'rejected=1,other=10'),
+                help='relative weights of line kinds (default: \
+                      sent=2,received=2,greylisted=1,rejected=1,other=10)')
+    argp.add_argument('-z', '--compress', choices=('none', 'gz', 'xz'),
+                default='gz',
+                help='compression of mail.log.2 and older (default: gz)')
+    argp.add_argument('-e', '--end', metavar='TIME',
+                help='time of the last line, YYYY-MM-DDTHH:MM:SS \
+                      (default: now)')
+    argp.add_argument('--seed', type=int, default=0,
+                help='seed of the random generator (default: 0)')
+    args = argp.parse_args()
+
+    end = datetime.now().replace(microsecond=0)
+    if args.end:
+        end = datetime.strptime(args.end, '%Y-%m-%dT%H:%M:%S')
+    rate = args.rate
+    if args.size:
+        # about 165 bytes per line with the default templates
+        rate = args.size / 165 / (args.days * 86400)
+    lines = generate(args.directory, end, args.days, rate, args.mix,
+                     args.compress, args.seed)
+    print('{} lines written to {}'.format(lines, args.directory))
+
+if __name__ == '__main__':
+    main()
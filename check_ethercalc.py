@@ -9,42 +9,190 @@ import argparse
 from datetime import datetime, timedelta
 import nagiosplugin
 import re
-import requests
 import time
+import urllib.parse
+
+from checkutils import Timings, loadJson, pooledSession, saveJson, \
+                       verboseTimings
+
+# Rooms ignored by default, form data of other rooms
+EXCLUDE    = ['_formdata$']
+# Room lookups queued at once
+BATCH_SIZE = 1024
+# Metrics of each mode besides roomcount
+METRICS = {
+    'count': (),
+    'age':   ('roomage', ),
+    'size':  ('roomsize', ),
+    'all':   ('roomage', 'roomsize'),
+}
 
 class EtherCalc(nagiosplugin.Resource):
     """Domain model: Count of Ethercalc rooms.
 
-    Determines the count of rooms on an Ethercalc instance.
+    Determines the count of rooms on an Ethercalc instance and, for the
+    age and size modes, the oldest modification time and total size of
+    their sheets.
     """
 
-    def __init__(self, protocol='http', host='localhost', port=8000):
-        self.protocol   = protocol
-        self.host       = host
-        self.port       = port
-        self.roomids    = self.getCalcIDs()
+    def __init__(self, protocol='http', host='localhost', port=8000,
+                       mode='count', exclude=EXCLUDE, concurrency=8,
+                       cachefile=None, timings=None):
+        self.protocol    = protocol
+        self.host        = host
+        self.port        = port
+        self.mode        = mode
+        self.exclude     = re.compile('|'.join(
+                               '(?:{})'.format(e) for e in exclude))
+        self.concurrency = concurrency
+        self.cachefile   = cachefile
+        self.timings     = timings or Timings()
+        self.session     = None
+
+    def getSession(self):
+        if self.session is None:
+            self.session = pooledSession(self.concurrency)
+        return self.session
+
+    def baseUrl(self):
+        return '{}://{}:{}'.format(self.protocol, self.host, self.port)
 
     def getCalcIDs(self):
-        req = requests.get('{}://{}:{}/_rooms/'.format(self.protocol,
-                self.host, self.port))
-        rooms = req.json()
-        matched = re.compile('.*_formdata$').search
+        req = self.getSession().get('{}/_rooms/'.format(self.baseUrl()),
+                timeout=120)
+        self.timings.count('requests', 1)
+        self.timings.count('bytes', len(req.content))
+        matched = self.exclude.search
         roomids = []
-        for room in rooms:
-            if not matched(room):
+        for room in req.json():
+            if not (self.exclude.pattern and matched(room)):
                 roomids.append(room)
         return roomids
 
+    def loadCache(self):
+        cache = loadJson(self.cachefile) or {}
+        if cache.get('instance') != self.baseUrl():
+            return {}
+        return cache.get('rooms', {})
+
+    def saveCache(self, rooms):
+        saveJson(self.cachefile, {'instance': self.baseUrl(), 'rooms': rooms})
+
+    def getRoomStats(self, room, cached):
+        # Return [etag, size, crc, modified] of the room's sheet, None if
+        # the room was deleted since it was listed. The sheet is only
+        # downloaded if its ETag changed, but every room takes a request:
+        # Ethercalc can't list changes. Without a Last-Modified header, the
+        # time a changed sheet is first seen is its modification time.
+        import email.utils
+        import requests
+        import zlib
+        headers = {}
+        if cached and cached[0]:
+            headers['If-None-Match'] = cached[0]
+        url = '{}/_/{}'.format(self.baseUrl(),
+                               urllib.parse.quote(room, safe=''))
+        try:
+            req = self.getSession().get(url, headers=headers, timeout=120)
+            if req.status_code == 304:
+                return cached
+            if req.status_code == 404:
+                return None
+            req.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            raise nagiosplugin.CheckError(
+                'cannot fetch {}: {}'.format(url, e))
+        crc = zlib.crc32(req.content)
+        if cached and cached[2] == crc:
+            modified = cached[3]
+        elif 'Last-Modified' in req.headers:
+            modified = int(email.utils.parsedate_to_datetime(
+                    req.headers['Last-Modified']).timestamp())
+        else:
+            modified = int(time.time())
+        return [req.headers.get('ETag'), len(req.content), crc, modified]
+
+    def getRooms(self, roomids):
+        # Look up at most `concurrency` rooms at a time. Rooms no longer
+        # listed or deleted since they were listed are dropped from the
+        # cache.
+        import concurrent.futures
+        with self.timings.phase('cache'):
+            cache = self.loadCache() if self.cachefile else {}
+        rooms = {}
+        gone = set()
+        pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.concurrency)
+        try:
+            for start in range(0, len(roomids), BATCH_SIZE):
+                batch = roomids[start:start + BATCH_SIZE]
+                # counted here, the lookups run in other threads
+                self.timings.count('requests', len(batch))
+                for (room, stats) in zip(batch, pool.map(self.getRoomStats,
+                        batch, [cache.get(room) for room in batch])):
+                    if stats is None:
+                        gone.add(room)
+                        continue
+                    if stats is cache.get(room):
+                        self.timings.count('not_modified', 1)
+                    else:
+                        self.timings.count('bytes', stats[1])
+                    rooms[room] = stats
+        finally:
+            pool.shutdown(cancel_futures=True)
+            if self.cachefile:
+                # keep rooms not looked up yet for the next run
+                with self.timings.phase('cache'):
+                    self.saveCache({room: rooms.get(room, cache.get(room))
+                                    for room in roomids
+                                    if room in rooms or room in cache and
+                                       room not in gone})
+        return rooms
+
     def probe(self):
-        roomcount = len(self.roomids)
-        return [nagiosplugin.Metric('roomcount', roomcount, min=0,
-                                    context='roomcount')]
+        return self.timings.run(self.getMetrics) + self.timings.metrics()
+
+    def getMetrics(self):
+        with self.timings.phase('fetch'):
+            roomids = self.getCalcIDs()
+        metrics = [nagiosplugin.Metric('roomcount', len(roomids), min=0,
+                                       context='roomcount')]
+        if not METRICS[self.mode]:
+            return metrics
+        with self.timings.phase('lookup'):
+            rooms = self.getRooms(roomids)
+        if 'roomage' in METRICS[self.mode]:
+            if rooms:
+                roomage = min(stats[3] for stats in rooms.values())
+            else:
+                roomage = int(time.time())
+            metrics.append(nagiosplugin.Metric('roomage', roomage, min=0,
+                                               context='roomage'))
+        if 'roomsize' in METRICS[self.mode]:
+            roomsize = sum(stats[1] for stats in rooms.values())
+            metrics.append(nagiosplugin.Metric('roomsize', roomsize, 'B',
+                                               min=0, context='roomsize'))
+        return metrics
 
 class LoadSummary(nagiosplugin.Summary):
     def ok(self, results):
-        return '{} active rooms'.format(results['roomcount'].metric)
+        msgs = ['{} active rooms'.format(results['roomcount'].metric)]
+        if 'roomage' in results:
+            msgs.append('oldest room {} days'.format((datetime.now() -
+                    datetime.fromtimestamp(
+                        results['roomage'].metric.value)).days))
+        if 'roomsize' in results:
+            msgs.append('{} total'.format(results['roomsize'].metric))
+        return ', '.join(msgs)
 
-    problem = ok
+    def problem(self, results):
+        # an error occurred instead of getting metrics
+        if results.first_significant.metric is None:
+            return super().problem(results)
+        return self.ok(results)
+
+    def verbose(self, results):
+        return super().verbose(results) + verboseTimings(results)
 
 def main():
     argp = argparse.ArgumentParser(description=__doc__)
@@ -52,18 +200,71 @@ def main():
                 help='hostname of the Ethercalc instance (default: localhost)')
     argp.add_argument('-p', '--port', metavar='PORT', default='8000',
                 help='port of the Ethercalc instance (default: 8000)')
+    argp.add_argument('-m', '--mode', choices=list(METRICS), default='count',
+                help='count rooms only, or also get the oldest modification \
+                      time (age), the total size of the sheets (size) or \
+                      both (all) (default: count)')
+    argp.add_argument('-e', '--exclude', metavar='REGEX', action='append',
+                help='ignore rooms matching REGEX, repeatable (default: \
+                      _formdata$, an empty REGEX ignores none)')
+    argp.add_argument('-n', '--concurrency', metavar='N', type=int,
+                default=8,
+                help='number of concurrent room requests (default: 8)')
+    argp.add_argument('-f', '--cachefile', metavar='FILE',
+                help='file to cache room stats in, required for the age \
+                      and all modes; sheets that did not change are not \
+                      downloaded again, but still requested')
+    argp.add_argument('-v', '--verbose', action='count', default=0,
+                help='increase output verbosity (use up to 3 times)')
+    argp.add_argument('-T', '--timings', action='store_true',
+                help='report wall time of the check phases, the amount of \
+                      data read and the number of requests as perfdata')
+    argp.add_argument('--profile', metavar='FILE',
+                help='dump cProfile stats of the check to FILE')
     argp.add_argument('-w', '--warning', metavar='RANGE', default='',
                 help='return warning if room count is outside RANGE')
     argp.add_argument('-c', '--critical', metavar='RANGE', default='',
                 help='return critical if room count is outside RANGE')
+    argp.add_argument('-W', '--warning-days', metavar='DAYS', type=int,
+                default=0,
+                help='return warning if oldest modified room is older than \
+                      DAYS')
+    argp.add_argument('-C', '--critical-days', metavar='DAYS', type=int,
+                default=0,
+                help='return critical if oldest modified room is older than \
+                      DAYS')
+    argp.add_argument('-s', '--warning-size', metavar='RANGE', default='',
+                help='return warning if total size in bytes is outside RANGE')
+    argp.add_argument('-S', '--critical-size', metavar='RANGE', default='',
+                help='return critical if total size in bytes is outside RANGE')
     args = argp.parse_args()
+    if args.mode in ('age', 'all') and not args.cachefile:
+        argp.error('--mode {} requires --cachefile, the modification times '
+                   'of the sheets are kept there'.format(args.mode))
+
+    if args.warning_days:
+        args.warning_days = int(time.mktime((datetime.now() -
+                timedelta(days=args.warning_days)).timetuple()))
+    if args.critical_days:
+        args.critical_days = int(time.mktime((datetime.now() -
+                timedelta(days=args.critical_days)).timetuple()))
 
     check = nagiosplugin.Check(
-                EtherCalc(host=args.hostname, port=args.port),
+                EtherCalc(host=args.hostname, port=args.port, mode=args.mode,
+                    exclude=EXCLUDE if args.exclude is None else
+                            [e for e in args.exclude if e],
+                    concurrency=args.concurrency, cachefile=args.cachefile,
+                    timings=Timings(args.timings, args.profile)),
                 nagiosplugin.ScalarContext('roomcount', args.warning,
                     args.critical),
+                nagiosplugin.ScalarContext('roomage',
+                    "{}:".format(args.warning_days),
+                    "{}:".format(args.critical_days), fmt_metric='{value}'),
+                nagiosplugin.ScalarContext('roomsize', args.warning_size,
+                    args.critical_size),
+                nagiosplugin.ScalarContext('timings'),
                 LoadSummary())
-    check.main()
+    check.main(verbose=args.verbose, timeout=120)
 
 if __name__ == '__main__':
     main()
@@ -6,11 +6,25 @@
 # (c) 2018 doobry@systemli.org
 
 import argparse
+import codecs
 from datetime import datetime, timedelta
+import json
 import nagiosplugin
-import requests
+import re
 import time
 
+from checkutils import Timings, loadJson, pooledSession, saveJson, \
+                       verboseTimings
+
+# Start of the pad ID array in the reply to listAllPads
+PADIDS_RE  = re.compile(r'"padIDs"\s*:\s*\[')
+PADID_RE   = re.compile(r'\s*,?\s*("(?:[^"\\]|\\.)*")')
+END_RE     = re.compile(r'\s*\]')
+# Bytes read at once from streamed replies
+CHUNK_SIZE = 64 * 1024
+# Pad lookups queued at once
+BATCH_SIZE = 1024
+
 class EtherPad(nagiosplugin.Resource):
     """Domain model: Count of Etherpad pads.
 
@@ -19,7 +33,8 @@ class EtherPad(nagiosplugin.Resource):
 
     def __init__(self, protocol='http', host='localhost', port=9001,
                        apiversion='1.2.13', apikey='abc', suffix=None,
-                       ignoresuffix=[]):
+                       ignoresuffix=[], concurrency=8, cachefile=None,
+                       timings=None):
         self.protocol     = protocol
         self.host         = host
         self.port         = port
@@ -27,48 +42,189 @@ class EtherPad(nagiosplugin.Resource):
         self.apikey       = apikey
         self.suffix       = suffix
         self.ignoresuffix = ignoresuffix
-        self.padids       = self.getPadIDs()
+        self.concurrency  = concurrency
+        self.cachefile    = cachefile
+        self.timings      = timings or Timings()
+        self.session      = None
+        self.padcount     = 0
+        self.padids       = b''
+
+    def getSession(self):
+        if self.session is None:
+            self.session = pooledSession(self.concurrency)
+        return self.session
+
+    def apiUrl(self, apicmd):
+        return '{}://{}:{}/api/{}/{}'.format(self.protocol, self.host,
+                self.port, self.apiversion, apicmd)
 
     def fetchApi(self, apicmd, apiargs):
         payload = {'apikey': self.apikey}
         if apiargs:
             payload = {**payload, **apiargs}
-        req = requests.get('{}://{}:{}/api/{}/{}'.format(self.protocol,
-                self.host, self.port, self.apiversion, apicmd),
-                 params=payload, timeout=120)
+        req = self.getSession().get(self.apiUrl(apicmd), params=payload,
+                timeout=120)
         return req.json()
 
+    def streamPadIDs(self):
+        # Yield the pad IDs of listAllPads while the reply is read, without
+        # parsing the whole document. IDs are matched in each chunk once
+        # the start of the array was found, only IDs with escapes are
+        # decoded as JSON.
+        utf8 = codecs.getincrementaldecoder('utf-8')()
+        with self.getSession().get(self.apiUrl('listAllPads'),
+                params={'apikey': self.apikey}, stream=True,
+                timeout=120) as req:
+            buf = ''
+            pos = None
+            self.timings.count('requests', 1)
+            for chunk in req.iter_content(CHUNK_SIZE):
+                self.timings.count('bytes', len(chunk))
+                buf += utf8.decode(chunk)
+                if pos is None:
+                    m = PADIDS_RE.search(buf)
+                    if not m:
+                        continue
+                    pos = m.end()
+                for m in PADID_RE.finditer(buf, pos):
+                    if m.start() != pos:
+                        break
+                    id = m.group(1)
+                    yield json.loads(id) if '\\' in id else id[1:-1]
+                    pos = m.end()
+                if END_RE.match(buf, pos):
+                    return
+                buf = buf[pos:]
+                pos = 0
+        raise nagiosplugin.CheckError('no pad IDs in reply to listAllPads')
+
     def getPadIDs(self):
-        apires = self.fetchApi(apicmd='listAllPads', apiargs='')
-        allpadids = apires['data']['padIDs']
-        padids = []
-        for id in allpadids:
+        # Filter pad IDs as they arrive and keep the considered ones NUL
+        # separated in a single buffer instead of a list of strings
+        ignoresuffix = tuple(self.ignoresuffix or ())
+        padids = bytearray()
+        padcount = 0
+        for id in self.streamPadIDs():
             if self.suffix and not id.endswith(self.suffix):
                 continue
-            if self.ignoresuffix and id.endswith(tuple(self.ignoresuffix)):
-                    continue
-            padids.append(id)
-        return padids
+            if ignoresuffix and id.endswith(ignoresuffix):
+                continue
+            padids += id.encode('utf-8') + b'\0'
+            padcount += 1
+        return (padcount, bytes(padids))
+
+    def iterPadIDs(self):
+        start = 0
+        while start < len(self.padids):
+            end = self.padids.index(b'\0', start)
+            yield self.padids[start:end].decode('utf-8')
+            start = end + 1
+
+    def getLastEdited(self, id):
+        apires = self.fetchApi(apicmd='getLastEdited', apiargs={'padID': id})
+        return apires['data']['lastEdited']
+
+    def cacheKey(self):
+        return '{}://{}:{}'.format(self.protocol, self.host, self.port)
+
+    def loadCache(self):
+        cache = loadJson(self.cachefile) or {}
+        if cache.get('instance') != self.cacheKey():
+            return {}
+        return cache.get('lastedited', {})
+
+    def saveCache(self, lastedited):
+        saveJson(self.cachefile, {'instance': self.cacheKey(),
+                                  'lastedited': lastedited})
+
+    def lookupPads(self, pool, ids, lastedited, oldestedited):
+        # Look up the lastEdited times of ids into lastedited (unless it's
+        # None), returns the oldest of them and oldestedited. Requests are
+        # counted here, the lookups run in other threads.
+        self.timings.count('requests', len(ids))
+        for (id, value) in zip(ids, pool.map(self.getLastEdited, ids)):
+            if lastedited is not None:
+                lastedited[id] = value
+            if value and (oldestedited == 0 or value < oldestedited):
+                oldestedited = value
+        return oldestedited
 
     def getOldestEditedPad(self):
+        # Look up at most `concurrency` pads at a time, pads that were
+        # never edited (lastEdited 0) don't count.
+        #
+        # lastEdited only ever increases, so a cached value is a lower
+        # bound of the current one. Pads without cached value are looked
+        # up, then cached pads in order of their cached value only as long
+        # as it's older than the oldest value looked up so far; the rest
+        # can't be the oldest pad. Pads never edited are cached with 0, the
+        # lowest bound there is, so they are looked up on every run: once
+        # edited, any of them may be the oldest pad.
+        import concurrent.futures
+        import heapq
+        with self.timings.phase('cache'):
+            cache = self.loadCache() if self.cachefile else {}
+        # cached pads are moved over as they are listed, pads that were
+        # deleted or filtered since the last run are dropped
+        lastedited = {} if self.cachefile else None
+        candidates = []
         oldestedited = 0
-        for id in self.padids:
-            apiargs = {'padID': id}
-            apires  = self.fetchApi(apicmd='getLastEdited',
-                      apiargs=apiargs)
-            lastedited = apires['data']['lastEdited']
-            if oldestedited > lastedited:
-                oldestedited = lastedited
-            elif oldestedited == 0:
-                oldestedited = lastedited
+        listed = False
+        pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.concurrency)
+        try:
+            # pads without cached value are looked up in batches while
+            # listing, queueing all futures at once takes long for many
+            # pads
+            batch = []
+            for id in self.iterPadIDs():
+                cached = cache.pop(id, None)
+                if cached is None:
+                    batch.append(id)
+                    if len(batch) == BATCH_SIZE:
+                        oldestedited = self.lookupPads(pool, batch,
+                                lastedited, oldestedited)
+                        batch = []
+                    continue
+                lastedited[id] = cached
+                candidates.append((cached, id))
+            listed = True
+            oldestedited = self.lookupPads(pool, batch, lastedited,
+                                           oldestedited)
+            heapq.heapify(candidates)
+            while True:
+                todo = []
+                while candidates and len(todo) < self.concurrency and \
+                      (oldestedited == 0 or candidates[0][0] < oldestedited):
+                    todo.append(heapq.heappop(candidates)[1])
+                if not todo:
+                    break
+                oldestedited = self.lookupPads(pool, todo, lastedited,
+                                               oldestedited)
+        finally:
+            # don't wait for queued lookups on timeout, but keep what was
+            # looked up so far, so a cold cache fills up over a few runs
+            pool.shutdown(cancel_futures=True)
+            if self.cachefile:
+                if not listed:
+                    # pads not listed yet aren't known to be gone
+                    lastedited.update(cache)
+                with self.timings.phase('cache'):
+                    self.saveCache(lastedited)
         return int(oldestedited / 1000)
 
     def probe(self):
-        padcount = len(self.padids)
+        return self.timings.run(self.getMetrics) + self.timings.metrics()
+
+    def getMetrics(self):
+        with self.timings.phase('fetch'):
+            (self.padcount, self.padids) = self.getPadIDs()
+        padcount = self.padcount
         if padcount == 0:
             padage = int(time.mktime(datetime.utcnow().timetuple()))
         else:
-            padage = self.getOldestEditedPad()
+            with self.timings.phase('lookup'):
+                padage = self.getOldestEditedPad()
         return [nagiosplugin.Metric('padcount', padcount, min=0,
                                     context='padcount'),
                 nagiosplugin.Metric('padage', padage, min=0,
@@ -84,7 +240,15 @@ class LoadSummary(nagiosplugin.Summary):
         return '{} active pads, oldest pad {} days'.format(
                 results['padcount'].metric,
                 paddays)
-    problem = ok
+
+    def problem(self, results):
+        # an error occurred instead of getting metrics
+        if results.first_significant.metric is None:
+            return super().problem(results)
+        return self.ok(results)
+
+    def verbose(self, results):
+        return super().verbose(results) + verboseTimings(results)
 
 def main():
     argp = argparse.ArgumentParser(description=__doc__)
@@ -99,6 +263,19 @@ def main():
     argp.add_argument('-i', '--ignore-suffix', metavar='IGNORE-SUFFIX',
                 action='append',
                 help='limit considered pads by ignoring this suffix')
+    argp.add_argument('-n', '--concurrency', metavar='N', type=int,
+                default=8,
+                help='number of concurrent API requests (default: 8)')
+    argp.add_argument('-f', '--cachefile', metavar='FILE',
+                help='file to cache lastEdited times of pads in, only pads \
+                      that may be the oldest one are looked up again')
+    argp.add_argument('-v', '--verbose', action='count', default=0,
+                help='increase output verbosity (use up to 3 times)')
+    argp.add_argument('-T', '--timings', action='store_true',
+                help='report wall time of the check phases, the amount of \
+                      data read and the number of requests as perfdata')
+    argp.add_argument('--profile', metavar='FILE',
+                help='dump cProfile stats of the check to FILE')
     argp.add_argument('-w', '--warning', metavar='RANGE', default='',
                 help='return warning if pad count is outside RANGE')
     argp.add_argument('-c', '--critical', metavar='RANGE', default='',
@@ -119,15 +296,18 @@ def main():
                 timedelta(days=args.critical_days)).timetuple()))
 
     check = nagiosplugin.Check(
-                EtherPad(host=args.hostname, apikey=args.apikey,
-                    suffix=args.suffix, ignoresuffix=args.ignore_suffix),
+                EtherPad(host=args.hostname, port=args.port, apikey=args.apikey,
+                    suffix=args.suffix, ignoresuffix=args.ignore_suffix,
+                    concurrency=args.concurrency, cachefile=args.cachefile,
+                    timings=Timings(args.timings, args.profile)),
                 nagiosplugin.ScalarContext('padcount', args.warning,
                     args.critical),
                 nagiosplugin.ScalarContext('padage',
                     "{}:".format(args.warning_days),
                     "{}:".format(args.critical_days), fmt_metric='{value}'),
+                nagiosplugin.ScalarContext('timings'),
                 LoadSummary())
-    check.main(timeout=120)
+    check.main(verbose=args.verbose, timeout=120)
 
 if __name__ == '__main__':
     main()
@@ -6,168 +6,1070 @@
 # (c) 2018 doobry@systemli.org
 
 import argparse
+import calendar
 from datetime import datetime, timedelta
-from dateutil import parser
+import io
+import json
 import nagiosplugin
 import operator
 import os
 import re
 import sys
+import time
+
+from checkutils import Timings, loadJson, saveJson, verboseTimings
+
+# Resolution of the message counters kept in the state file
+BUCKET_FMT = '%Y-%m-%d %H:%M'
+# Seconds the state file keeps message counters by second for
+SECONDS_SPAN = 3600
+# Size of the blocks read when searching backwards from the end of the log
+BLOCK_SIZE = 8192
+# Size of the blocks of lines the log is parsed in
+CHUNK_SIZE = 1024 * 1024
+# Minimum size of a log to be parsed by several processes
+PARALLEL_SIZE = 16 * CHUNK_SIZE
+# Month abbreviations of classic syslog timestamps
+MONTHS = {m.encode(): i for i, m in enumerate(calendar.month_abbr) if m}
+# Counted log lines, the number of the matching group is the counter:
+# sent, received, greylisted, rejected. Matches extend to the end of the
+# line, so every line is counted at most once. The syslog tag may name a
+# Postfix instance (postfix-in/smtpd).
+LINE_RE = re.compile(rb' postfix(?:-[^/\s]+)?/(?:'
+    rb'(smtp)[^\n]* to[^\n]*, status=sent|'
+    rb'(pipe)[^\n]* to[^\n]*, relay=dovecot, [^\n]*, status=sent|'
+    rb'(smtpd)(?=[^\n]*Greylisted)[^\n]* NOQUEUE: reject:[^\n]* rejected:|'
+    rb'(smtpd)[^\n]* NOQUEUE: reject:[^\n]* rejected:)[^\n]*')
+
+# Fields of classified lines for the --top breakdown
+RBL_RE    = re.compile(rb'blocked using ([^;,\s]+)')
+REASON_RE = re.compile(rb' rejected: ([^;<]+)')
+RELAY_RE  = re.compile(rb' relay=([^\[,\s]+)')
+DOMAIN_RE = re.compile(rb' to=<[^@>]*@([^>]+)>')
+# Characters not allowed in breakdown and instance perfdata labels
+LABEL_RE  = re.compile(r'[^\w.@-]+')
+# Rotated log files, read as part of the rotation chain of their log file
+ROTATED_RE = re.compile(r'\.\d+(?:\.gz|\.xz)?$')
+# Keys kept per top counter, relative to the number of reported keys
+TOP_SLACK = 10
+# Seconds to wait for the log follower daemon
+SOCKET_TIMEOUT = 5
+# Supported time frames
+FRAMES = {'minute': timedelta(minutes=1),
+          'hour':   timedelta(hours=1),
+          'day':    timedelta(days=1),
+          'week':   timedelta(days=7)}
+# Names of the message counters
+COUNTERS = ('sent', 'received', 'greylisted', 'rejected')
 
 class Postfix(nagiosplugin.Resource):
     """Domain model: Get mail throughput from Postfix mail server.
 
-    Get mail throughput (by minute, hour, day, week) from Postfix mail logs.
+    Get mail throughput (by minute, hour, day, week) from Postfix mail logs,
+    of a single or several Postfix instances with separate log files.
     """
 
-    def __init__(self, logfile, mode):
-        self.logfile = logfile
-        self.mode    = mode
-        self.now     = datetime.now().replace(microsecond=0)
+    def __init__(self, logfile, mode, statefile=None, indexfile=None,
+                 jobs=1, socket=None, top=0, timings=None):
+        self.timings   = timings or Timings()
+        self.logfiles  = [logfile] if isinstance(logfile, str) \
+                         else list(logfile)
+        self.logfile   = self.logfiles[0]
+        self.instances = instanceNames(self.logfiles)
+        self.mode      = mode
+        self.statefile = statefile
+        self.indexfile = indexfile
+        self.jobs      = jobs
+        self.socket    = socket
+        self.topcount  = top
+        self.top       = None
+        if top:
+            self.top = {category: TopCounter(top * TOP_SLACK)
+                        for category in ('reason', 'relay', 'domain')}
+        self.index     = None
+        self.now       = datetime.now().replace(microsecond=0)
+        self.t_now     = self.toStamp(self.now)
+        self.months    = {}
+        self.skipped   = 0
+
+    def toStamp(self, t):
+        # Return comparable integer (seconds, local wall clock) for datetime
+        return calendar.timegm(t.timetuple())
+
+    def monthStart(self, year, month):
+        # Return timestamp of the first day of month, memoized
+        try:
+            return self.months[(year, month)]
+        except KeyError:
+            t_month = calendar.timegm((year, month, 1, 0, 0, 0))
+            self.months[(year, month)] = t_month
+            return t_month
 
     def timeFromLine(self, line):
-        # Return time object from mail log timestamp
+        # Return comparable integer from mail log timestamp, exit if line
+        # has none
         try:
-            t_line = parser.parse(line[0:15])
-            return t_line
-        except:
+            return self.parseTime(line)
+        except ValueError:
             print("Error: unable to get time from line: {}".format(line))
             sys.exit(255)
 
-    def g(self, logfile, t_search):
-        f = open(logfile)
-        # Get size of file in bytes
-        f.seek(0, 2)
-        f_size = f.tell()
+    def parseTime(self, line):
+        # Return comparable integer from mail log timestamp, either classic
+        # syslog ('Oct 17 00:58:39') or RFC 3339 ('2018-10-17T00:58:39+02:00'),
+        # raises ValueError if line has none
+        try:
+            if line[0:1].isdigit():
+                t_month = self.monthStart(int(line[0:4]), int(line[5:7]))
+                (day, clock) = (line[8:10], 11)
+            else:
+                # syslog omits the year, months after the current one
+                # belong to the previous year
+                month = MONTHS[line[0:3]]
+                t_month = self.monthStart(self.now.year, month)
+                if t_month > self.t_now:
+                    t_month = self.monthStart(self.now.year - 1, month)
+                (day, clock) = (line[4:6], 7)
+            return t_month + (int(day) - 1) * 86400 + \
+                   int(line[clock:clock + 2]) * 3600 + \
+                   int(line[clock + 3:clock + 5]) * 60 + \
+                   int(line[clock + 6:clock + 8])
+        except (KeyError, ValueError):
+            raise ValueError('no timestamp')
+
+    def skipLine(self, chunk, sol):
+        # Count a classified line starting at sol of chunk that has no
+        # timestamp (e.g. garbled by a crash). It is left out of the
+        # counters by time instead of stopping the check or the daemon.
+        self.skipped += 1
+        if self.skipped == 1:
+            print("Warning: skipping lines without time, e.g.: {}".format(
+                  chunk[sol:chunk.find(b'\n', sol)]), file=sys.stderr)
+
+    def alignLine(self, f, pos):
+        # Return offset of the first line starting at or after pos
+        if pos == 0:
+            return 0
+        f.seek(pos - 1)
+        f.readline()
+        return f.tell()
 
-        # Binary search through file
-        left, right = 0, f_size - 1
+    def lastLine(self, f):
+        # Return the last line of a file opened in binary mode. Reads
+        # backwards from EOF in blocks instead of scanning the whole file.
+        pos = f.seek(0, 2)
+        buf = b''
+        while pos > 0:
+            size = min(BLOCK_SIZE, pos)
+            pos -= size
+            f.seek(pos)
+            buf = f.read(size) + buf
+            # skip the newline terminating the last line
+            nl = buf.rfind(b'\n', 0, len(buf) - 1)
+            if nl != -1:
+                return buf[nl + 1:]
+        return buf
+
+    def searchLines(self, f, left, right, t_search):
+        # Binary search in binary file f between line starts left and right
+        # for the offset of the first line not older than t_search. Probes
+        # are realigned to line boundaries, so every step reads one line.
         while (left < right):
-            mid = int((left + right) / 2)
+            mid = self.alignLine(f, (left + right) // 2)
+            if mid >= right:
+                # no line starts between mid and right, probe left instead
+                mid = left
             f.seek(mid)
-            # no realign to a line
-            if mid:
-                f.readline()
-            t_line = self.timeFromLine(f.readline())
-            if t_search == t_line:
-                f.close()
-                return mid
-            elif t_search > t_line:
-                left = mid + 1
+            line = f.readline()
+            t_line = self.timeFromLine(line)
+            if t_search > t_line:
+                left = mid + len(line)
+            else:
+                right = mid
+        return left
+
+    def g(self, logfile, t_search):
+        f = open(logfile, 'rb')
+        start = self.searchLines(f, 0, f.seek(0, 2), t_search)
+        f.close()
+        return start
+
+    def readChunks(self, f, end=None):
+        # Yield large blocks of complete lines from binary file f up to
+        # offset end, an incomplete last line is left for the next run
+        rest = b''
+        left = None if end is None else end - f.tell()
+        while True:
+            if left is None:
+                data = f.read(CHUNK_SIZE)
+            else:
+                data = f.read(min(CHUNK_SIZE, left))
+                left -= len(data)
+            if not data:
+                return
+            nl = data.rfind(b'\n')
+            if nl == -1:
+                rest += data
+                continue
+            yield rest + data[:nl + 1]
+            rest = data[nl + 1:]
+
+    def isCompressed(self, path):
+        return path.endswith(('.gz', '.xz'))
+
+    def openLog(self, path):
+        # Open plain or compressed log file for binary reading
+        if path.endswith('.gz'):
+            import gzip
+            return gzip.open(path, 'rb')
+        if path.endswith('.xz'):
+            import lzma
+            return lzma.open(path, 'rb')
+        return open(path, 'rb')
+
+    def rotatedLogs(self, logfile):
+        # Yield logfile and its rotated predecessors (mail.log.1,
+        # mail.log.2.gz, ...), newest first
+        yield logfile
+        n = 1
+        while True:
+            for suffix in ('', '.gz', '.xz'):
+                path = '{}.{}{}'.format(logfile, n, suffix)
+                if os.path.isfile(path):
+                    yield path
+                    break
             else:
-                right = mid - 1
+                return
+            n += 1
+
+    def addBreakdown(self, idx, line):
+        # Count reject reason, relay and recipient domain of a classified
+        # line (from the postfix program tag on) into the top counters
+        if idx == 2:
+            self.top['reason'].add('greylisted')
+        elif idx == 3:
+            m = RBL_RE.search(line) or REASON_RE.search(line)
+            if m:
+                self.top['reason'].add(m.group(1)[:40].strip().decode(
+                        'utf-8', 'replace'))
+        else:
+            m = RELAY_RE.search(line)
+            if m:
+                self.top['relay'].add(m.group(1).decode('utf-8', 'replace'))
+        m = DOMAIN_RE.search(line)
+        if m:
+            self.top['domain'].add(m.group(1).lower().decode('utf-8',
+                                                             'replace'))
+
+    def countLines(self, chunk, start, end, stats, buckets=None,
+                   seconds=None):
+        # Count classified lines of chunk between offsets start and end into
+        # stats and, if given, per-minute buckets and per-second counters of
+        # the lines since t_seconds
+        if buckets is None and self.top is None:
+            for m in LINE_RE.finditer(chunk, start, end):
+                stats[m.lastindex - 1] += 1
+            return
+        if buckets is None:
+            for m in LINE_RE.finditer(chunk, start, end):
+                stats[m.lastindex - 1] += 1
+                self.addBreakdown(m.lastindex - 1, m.group(0))
+            return
+        minute, key, recent = None, None, False
+        for m in LINE_RE.finditer(chunk, start, end):
+            idx = m.lastindex - 1
+            sol = chunk.rfind(b'\n', 0, m.start()) + 1
+            try:
+                if chunk[sol:sol + 16] != minute:
+                    t_line = self.parseTime(chunk[sol:sol + 32])
+                    minute = chunk[sol:sol + 16]
+                    key = time.strftime(BUCKET_FMT, time.gmtime(t_line))
+                    # only lines of recent minutes need their own timestamp
+                    recent = seconds is not None and \
+                             t_line // 60 * 60 + 60 > self.t_seconds
+                elif recent:
+                    t_line = self.parseTime(chunk[sol:sol + 32])
+            except ValueError:
+                self.skipLine(chunk, sol)
+                continue
+            stats[idx] += 1
+            buckets.setdefault(key, [0, 0, 0, 0])[idx] += 1
+            if recent and t_line >= self.t_seconds:
+                seconds.setdefault(str(t_line), [0, 0, 0, 0])[idx] += 1
+
+    def parseStream(self, f, t_splits=(), buckets=None, end=None,
+                    seconds=None):
+        # Count classified lines of binary stream f from its current position
+        # on (up to offset end), separately for the time frames starting at
+        # ascending timestamps t_splits. Lines older than the first one are
+        # skipped, which is only needed for streams that can't be searched
+        # (compressed logs). Returns stats of every time frame (or of all
+        # lines, if there are no splits) and the number of bytes up to the
+        # last complete line.
+        segs = [[0, 0, 0, 0] for t in t_splits] or [[0, 0, 0, 0]]
+        seg = -1 if t_splits else 0
+        size = 0
+        for chunk in self.readChunks(f, end):
+            size += len(chunk)
+            if self.timings.enabled:
+                self.timings.count('lines', chunk.count(b'\n'))
+            start = 0
+            if seg + 1 < len(t_splits):
+                last = chunk.rfind(b'\n', 0, len(chunk) - 1) + 1
+                t_last = self.timeFromLine(chunk[last:last + 32])
+                while seg + 1 < len(t_splits) and t_splits[seg + 1] <= t_last:
+                    split = self.searchLines(io.BytesIO(chunk), start,
+                                             len(chunk), t_splits[seg + 1])
+                    if seg >= 0:
+                        self.countLines(chunk, start, split, segs[seg],
+                                        buckets, seconds)
+                    (start, seg) = (split, seg + 1)
+            if seg >= 0:
+                self.countLines(chunk, start, len(chunk), segs[seg], buckets,
+                                seconds)
+
+        # lines of later segments belong to the earlier time frames, too
+        for i in range(len(segs) - 2, -1, -1):
+            segs[i] = list(map(operator.add, segs[i], segs[i + 1]))
+        self.timings.count('bytes', size)
+        return ([tuple(stats) for stats in segs], size)
+
+    def resetCounters(self):
+        # Start over with empty top counters and timings in a worker
+        # process. The worker got a copy of this object, counts of the
+        # parent must not be returned again.
+        if self.top is not None:
+            self.top = {category: TopCounter(counter.size)
+                        for (category, counter) in self.top.items()}
+        self.timings = Timings(self.timings.enabled)
+
+    def mergeCounters(self, top, timings):
+        # Add top counters and timings of a worker process, phase times of
+        # parallel workers add up
+        if self.top is not None:
+            for (category, counter) in top.items():
+                self.top[category].merge(counter)
+        self.timings.merge(timings)
+
+    def parseRange(self, logfile, start, end, t_splits):
+        # Worker of parseParallel: return stats, top counters and timings
+        # of a part of logfile
+        self.resetCounters()
+        f = open(logfile, 'rb')
+        f.seek(start)
+        (stats, size) = self.parseStream(f, t_splits, end=end)
         f.close()
-        return mid
+        return (stats, self.top, self.timings)
+
+    def parseParallel(self, f, logfile, t_splits):
+        # Split plain logfile from the current position of f to its end on
+        # line boundaries and parse the parts in a pool of processes
+        start = f.tell()
+        end = f.seek(0, 2)
+        if end - start < PARALLEL_SIZE:
+            f.seek(start)
+            return self.parseStream(f, t_splits)[0]
+        bounds = [start]
+        for i in range(1, self.jobs):
+            bounds.append(self.alignLine(f, start + (end - start) * i // self.jobs))
+        bounds.append(end)
+        parts = [(logfile, a, b, t_splits)
+                 for (a, b) in zip(bounds, bounds[1:]) if a < b]
+        import multiprocessing
+        with multiprocessing.Pool(len(parts)) as pool:
+            results = pool.starmap(self.parseRange, parts)
+        for (stats, top, timings) in results:
+            self.mergeCounters(top, timings)
+        # add up the stats of every time frame
+        return [tuple(map(sum, zip(*frame)))
+                for frame in zip(*[stats for (stats, top, timings) in results])]
 
     def parseLogs(self, logfile, start=0):
-        (sent, recv, grey, rjct) = (0, 0, 0, 0)
-        f = open(logfile)
+        f = open(logfile, 'rb')
         f.seek(start)
-        f.readline()
-        for line in f:
-            if re.search(" postfix/smtp.* to.*, status=sent", line):
-                sent += 1
-            elif re.search(" postfix/pipe.* to.*, relay=dovecot, .*, status=sent", line):
-                recv += 1
-            elif re.search(" postfix/smtpd.* NOQUEUE: reject:.* rejected:", line):
-                if re.search("Greylisted", line):
-                    grey += 1
-                else:
-                    rjct += 1
+        (stats, size) = self.parseStream(f)
+        f.close()
+        return stats[0]
+
+    def sumSeconds(self, seconds, t_search):
+        # Return stats of all per-second counters not older than t_search
+        stats = (0, 0, 0, 0)
+        for key, counts in seconds.items():
+            if int(key) >= t_search:
+                stats = tuple(map(operator.add, stats, counts))
+        return stats
 
+    def sumBuckets(self, buckets, t_search):
+        # Return stats of all per-minute buckets not older than t_search
+        k_search = time.strftime(BUCKET_FMT, time.gmtime(t_search))
+        stats = (0, 0, 0, 0)
+        for key, counts in buckets.items():
+            if key >= k_search:
+                stats = tuple(map(operator.add, stats, counts))
+        return stats
+
+    def indexedLog(self, path):
+        # Return index entry (first timestamp and per-minute buckets) of a
+        # compressed log file, compressed logs are only inflated once
+        stat = os.stat(path)
+        key = '{}:{}:{}'.format(stat.st_ino, stat.st_size, int(stat.st_mtime))
+        if key not in self.index:
+            f = self.openLog(path)
+            line = f.readline()
+            f.seek(0)
+            entry = {'first': self.timeFromLine(line) if line else 0,
+                     'buckets': {}}
+            with self.timings.phase('parse'):
+                self.parseStream(f, buckets=entry['buckets'])
+            f.close()
+            self.index[key] = entry
+        return self.index[key]
+
+    def readLogs(self, logfile, t_splits, buckets=None, rotated=0,
+                 seconds=None):
+        # Walk logfile and its rotation chain from newest to oldest until the
+        # oldest of the ascending timestamps t_splits is reached, skipping
+        # the first `rotated` files. Files completely within the time frame
+        # are parsed from the start, older files are never opened. Returns
+        # stats of the time frames starting at each of t_splits.
+        t_search = t_splits[0]
+        stats = [(0, 0, 0, 0) for t in t_splits]
+        for path in list(self.rotatedLogs(logfile))[rotated:]:
+            entry = None
+            if self.index is not None and self.isCompressed(path):
+                entry = self.indexedLog(path)
+                if seconds is not None and \
+                        max(entry['buckets'], default='') >= time.strftime(
+                            BUCKET_FMT, time.gmtime(self.t_seconds)):
+                    # recent lines are needed by second, parse the file
+                    entry = None
+                elif buckets is None and any(
+                        t % 60 and time.strftime(BUCKET_FMT, time.gmtime(t))
+                        in entry['buckets'] for t in t_splits):
+                    # a time frame starts within a minute of this file,
+                    # parse it to count exactly from there
+                    entry = None
+            if entry is not None:
+                counts = [self.sumBuckets(entry['buckets'], t) for t in t_splits]
+                if buckets is not None:
+                    k_search = time.strftime(BUCKET_FMT, time.gmtime(t_search))
+                    for key, value in entry['buckets'].items():
+                        if key >= k_search:
+                            buckets[key] = list(map(operator.add, value,
+                                    buckets.get(key, [0, 0, 0, 0])))
+                t_first = entry['first']
+            else:
+                f = self.openLog(path)
+                line = f.readline()
+                if line == b'':
+                    f.close()
+                    continue
+                t_first = self.timeFromLine(line)
+                f.seek(0)
+                if not self.isCompressed(path) and t_search >= t_first:
+                    with self.timings.phase('bisect'):
+                        if t_search > self.timeFromLine(self.lastLine(f)):
+                            f.close()
+                            return stats
+                        # parse logfile from detected startpoint
+                        f.seek(self.searchLines(f, 0, f.seek(0, 2), t_search))
+                with self.timings.phase('parse'):
+                    if self.jobs > 1 and buckets is None and \
+                            not self.isCompressed(path):
+                        counts = self.parseParallel(f, path, t_splits)
+                    else:
+                        (counts, size) = self.parseStream(f, t_splits,
+                                buckets, seconds=seconds)
+                f.close()
+            stats = [tuple(map(operator.add, a, b))
+                     for (a, b) in zip(stats, counts)]
+            if t_search >= t_first:
+                return stats
+        print("Warning: Couldn't find all logs, stats are incomplete",
+              file=sys.stderr)
+        return stats
+
+    def bucketLogs(self, logfile, start, buckets, seconds=None):
+        # Count classified lines from start to the end of logfile into
+        # per-minute buckets (and per-second counters). Returns inode and
+        # offset after the last complete line, an incomplete last line is
+        # left for the next run.
+        f = open(logfile, 'rb')
+        offset = self.alignLine(f, start)
+        f.seek(offset)
+        with self.timings.phase('parse'):
+            (stats, size) = self.parseStream(f, buckets=buckets,
+                                             seconds=seconds)
+        inode = os.fstat(f.fileno()).st_ino
         f.close()
-        return (sent, recv, grey, rjct)
+        return (inode, offset + size)
 
-    def readLogs(self, logfile, t_search, recurse=0):
-        f = open(logfile)
-        # read first line
+    def startOffset(self, logfile, t_search):
+        # Return offset to start reading logfile at for t_search
+        f = open(logfile, 'rb')
         line = f.readline()
-        t_first = self.timeFromLine(line)
-
-        if t_search < t_first:
-            f.close() 
-            # start timestamp is before logfile, parse whole logfile
-            stats = self.parseLogs(logfile, 0)
-            # if possible, read parent logfile
-            l_rotated = "{}.1".format(logfile)
-            if recurse == 0 and os.path.isfile(l_rotated):
-                print("RECURSE!!")
-                stats_rotated = self.readLogs(l_rotated, t_search, 1)
-                stats = tuple(map(operator.add, stats, stats_rotated))
-            else:
-                print("Warning: Couldn't find all logs, stats are incomplete")
-            return stats
+        f.close()
+        if line == b'' or t_search <= self.timeFromLine(line):
+            return 0
+        with self.timings.phase('bisect'):
+            return self.g(logfile, t_search)
+
+    def loadJson(self, path):
+        with self.timings.phase('state'):
+            return loadJson(path)
 
-        # read last line
-        last = line
-        while (line != ''):
-            last = line
+    def saveJson(self, path, data):
+        with self.timings.phase('state'):
+            saveJson(path, data)
+
+    def loadState(self):
+        state = self.loadJson(self.statefile)
+        if not state or state.get('logfile') != self.logfile or \
+                'head' not in state or 'seconds' not in state:
+            return None
+        return state
+
+    def firstLine(self, path):
+        # Return checksum of the first complete line of path. It identifies
+        # the log across renaming, copying and truncating, which the inode
+        # doesn't.
+        import zlib
+        with open(path, 'rb') as f:
             line = f.readline()
-        t_last = self.timeFromLine(last)
+        return zlib.crc32(line) if line.endswith(b'\n') else None
 
-        f.close()
+    def saveIndex(self):
+        # Drop index entries of log files that were deleted by logrotate
+        inodes = set()
+        for path in self.rotatedLogs(self.logfile):
+            inodes.add(str(os.stat(path).st_ino))
+        self.saveJson(self.indexfile, {key: entry for key, entry
+                in self.index.items() if key.split(':')[0] in inodes})
 
-        if t_search > t_last:
-            return (0, 0, 0, 0)
+    def fillBuckets(self, t_oldest, buckets, seconds=None):
+        # Count lines since t_oldest from the whole rotation chain into
+        # per-minute buckets (and per-second counters). Returns inode and
+        # offset after the last complete line of logfile.
+        # buckets hold whole minutes, the first one, too
+        t_oldest = t_oldest // 60 * 60
+        start = self.startOffset(self.logfile, t_oldest)
+        (inode, offset) = self.bucketLogs(self.logfile, start, buckets,
+                                          seconds)
+        if start == 0:
+            self.readLogs(self.logfile, [t_oldest], buckets, rotated=1,
+                          seconds=seconds)
+        return (inode, offset)
+
+    def continues(self, state, path):
+        # Return True if path is the file the checkpoint state was taken of,
+        # possibly grown since
+        if state['offset'] == 0:
+            return True
+        return state['offset'] <= os.path.getsize(path) and \
+               state['head'] == self.firstLine(path)
+
+    def readCheckpoint(self, t_splits):
+        # Parse only what was appended to the log since the last run and
+        # answer from the counters kept in the state file: per second for
+        # the last hour, exact for time frames starting within, and per
+        # minute for the last week
+        t_oldest = self.toStamp(self.now - timedelta(days=7))
+        self.t_seconds = self.t_now - SECONDS_SPAN
+        l_rotated = "{}.1".format(self.logfile)
+        state = self.loadState()
+        stat = os.stat(self.logfile)
+
+        if state and state['inode'] == stat.st_ino and \
+                self.continues(state, self.logfile):
+            (buckets, seconds) = (state['buckets'], state['seconds'])
+            (inode, offset) = self.bucketLogs(self.logfile, state['offset'],
+                                              buckets, seconds)
+        elif state and os.path.isfile(l_rotated) and \
+                self.continues(state, l_rotated):
+            # logfile got rotated (renamed, or copied and truncated) since
+            # last run, finish the rotated file before starting over with
+            # the new one
+            (buckets, seconds) = (state['buckets'], state['seconds'])
+            self.bucketLogs(l_rotated, state['offset'], buckets, seconds)
+            (inode, offset) = self.bucketLogs(self.logfile, 0, buckets,
+                                              seconds)
         else:
-            # parse logfile from detected startpoint
-            start = self.g(logfile, t_search)
-            stats = self.parseLogs(logfile, start)
-            return stats
+            # no usable checkpoint, fill the buckets for a whole week
+            (buckets, seconds) = ({}, {})
+            (inode, offset) = self.fillBuckets(t_oldest, buckets, seconds)
+
+        k_oldest = time.strftime(BUCKET_FMT, time.gmtime(t_oldest))
+        buckets = {k: v for k, v in buckets.items() if k >= k_oldest}
+        seconds = {k: v for k, v in seconds.items()
+                   if int(k) >= self.t_seconds}
+        self.saveJson(self.statefile, {'logfile': self.logfile,
+                'inode': inode, 'offset': offset,
+                'head': self.firstLine(self.logfile), 'buckets': buckets,
+                'seconds': seconds})
+        return [self.sumSeconds(seconds, t) if t >= self.t_seconds
+                else self.sumBuckets(buckets, t) for t in t_splits]
+
+    def querySocket(self, t_splits):
+        # Ask a running LogFollower daemon for the stats of the time frames
+        import socket
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(SOCKET_TIMEOUT)
+        try:
+            sock.connect(self.socket)
+            sock.sendall(json.dumps(t_splits).encode('ascii') + b'\n')
+            reply = sock.makefile('rb').readline()
+        finally:
+            sock.close()
+        return [tuple(stats) for stats in json.loads(reply.decode('ascii'))]
 
     def probe(self):
-        if self.mode == 'minute':
-            t_start = self.now - timedelta(minutes=1)
-        if self.mode == 'hour':
-            t_start = self.now - timedelta(hours=1)
-        if self.mode == 'day':
-            t_start = self.now - timedelta(days=1)
-        if self.mode == 'week':
-            t_start = self.now - timedelta(days=7)
-
-        (sent, recv, grey, rjct) = self.readLogs(self.logfile, t_start)
-        return [nagiosplugin.Metric('sent', sent, min=0,
-                                context=self.mode),
-                nagiosplugin.Metric('received', recv, min=0,
-                                context=self.mode),
-                nagiosplugin.Metric('greylisted', grey, min=0,
-                                context=self.mode),
-                nagiosplugin.Metric('rejected', rjct, min=0,
-                                context=self.mode)]
+        return self.timings.run(self.getMetrics) + self.timings.metrics()
+
+    def getStats(self, t_splits):
+        # Return stats of the time frames starting at t_splits for logfile
+        stats = None
+        if self.socket and self.top is None:
+            try:
+                with self.timings.phase('socket'):
+                    stats = self.querySocket(t_splits)
+            except (OSError, ValueError):
+                # daemon isn't running, parse the logs directly
+                stats = None
+        if stats is None and self.top is not None:
+            # the breakdown needs the lines themselves, not just counters
+            stats = self.readLogs(self.logfile, t_splits)
+        if stats is None:
+            if self.indexfile:
+                self.index = self.loadJson(self.indexfile) or {}
+            if self.statefile:
+                stats = self.readCheckpoint(t_splits)
+            else:
+                stats = self.readLogs(self.logfile, t_splits)
+            if self.indexfile:
+                self.saveIndex()
+        return stats
+
+    def instanceStats(self, instance, logfile, t_splits):
+        # Worker of getMetrics for several log files: return stats, top
+        # counters and timings of one instance. State and index files are
+        # kept per instance, so workers don't overwrite each other's.
+        self.resetCounters()
+        self.logfile = logfile
+        # worker processes can't start processes of their own
+        self.jobs = 1
+        if self.statefile:
+            self.statefile = '{}.{}'.format(self.statefile, instance)
+        if self.indexfile:
+            self.indexfile = '{}.{}'.format(self.indexfile, instance)
+        return (self.getStats(t_splits), self.top, self.timings)
+
+    def getMetrics(self):
+        if self.mode == 'all':
+            frames = list(FRAMES)
+        else:
+            frames = [self.mode]
+        # time frames starting at ascending timestamps
+        frames.sort(key=lambda frame: FRAMES[frame], reverse=True)
+        t_splits = [self.toStamp(self.now - FRAMES[frame]) for frame in frames]
+
+        instances = []
+        if len(self.logfiles) == 1:
+            stats = self.getStats(t_splits)
+        else:
+            # locate and parse the log files of all instances in up to
+            # --jobs processes
+            import multiprocessing
+            with multiprocessing.Pool(min(len(self.logfiles),
+                                          self.jobs)) as pool:
+                results = pool.starmap(self.instanceStats,
+                        [(instance, logfile, t_splits) for (instance, logfile)
+                         in zip(self.instances, self.logfiles)])
+            for (instance, (stats, top, timings)) in zip(self.instances,
+                                                         results):
+                self.mergeCounters(top, timings)
+                instances.append((instance, stats))
+            # add up the stats of every time frame
+            stats = [tuple(map(sum, zip(*frame))) for frame
+                     in zip(*[stats for (instance, stats) in instances])]
+
+        metrics = []
+        for (frame, counts) in zip(frames, stats):
+            for (name, value) in zip(COUNTERS, counts):
+                context = self.mode
+                if self.mode == 'all':
+                    name = context = '{}_{}'.format(name, frame)
+                metrics.append(nagiosplugin.Metric(name, value, min=0,
+                                                   context=context))
+        for (instance, instance_stats) in instances:
+            for (frame, counts) in zip(frames, instance_stats):
+                for (name, value) in zip(COUNTERS, counts):
+                    if self.mode == 'all':
+                        name = '{}_{}'.format(name, frame)
+                    metrics.append(nagiosplugin.Metric(
+                            '{}_{}'.format(name, instance), value, min=0,
+                            context='instance'))
+        if self.top is not None:
+            for (category, counter) in self.top.items():
+                for (key, value) in counter.top(self.topcount):
+                    name = '{}_{}'.format(category,
+                                          LABEL_RE.sub('_', key))
+                    metrics.append(nagiosplugin.Metric(name, value, min=0,
+                                                       context='breakdown'))
+        return metrics
+
+class TopCounter:
+    """Approximate counts of the most frequent keys in constant memory.
+
+    Space-saving algorithm: at most `size` keys are kept, a new key
+    replaces the one with the lowest count and inherits that count, so
+    counts may be overestimated for rare keys. The keys are kept in a
+    heap by the count they had when they were pushed, which is a lower
+    bound as counts only grow; outdated entries are only updated when
+    they come up as the minimum.
+    """
+
+    def __init__(self, size):
+        self.size   = size
+        self.counts = {}
+        self.heap   = []
+
+    def add(self, key, count=1):
+        import heapq
+        if key in self.counts:
+            self.counts[key] += count
+            return
+        if len(self.counts) < self.size:
+            self.counts[key] = count
+            heapq.heappush(self.heap, (count, key))
+            return
+        while self.heap[0][0] != self.counts[self.heap[0][1]]:
+            victim = self.heap[0][1]
+            heapq.heapreplace(self.heap, (self.counts[victim], victim))
+        (low, victim) = self.heap[0]
+        del self.counts[victim]
+        self.counts[key] = low + count
+        heapq.heapreplace(self.heap, (low + count, key))
+
+    def merge(self, other):
+        for (key, count) in other.counts.items():
+            self.add(key, count)
+
+    def top(self, k):
+        return sorted(self.counts.items(), key=lambda item: item[1],
+                      reverse=True)[:k]
+
+class RingBuffer:
+    """Message counters of the last `size` time slots of `resolution`
+    seconds each, older slots are overwritten."""
+
+    def __init__(self, size, resolution):
+        self.resolution = resolution
+        self.slots      = [None] * size
+        self.counts     = [[0, 0, 0, 0] for i in range(size)]
+
+    def add(self, t, idx, count=1):
+        slot = t // self.resolution
+        i = slot % len(self.slots)
+        if self.slots[i] != slot:
+            self.slots[i] = slot
+            self.counts[i] = [0, 0, 0, 0]
+        self.counts[i][idx] += count
+
+    def sum(self, t_from, t_to):
+        # Return stats of the slots starting between t_from and t_to
+        (first, last) = (-(-t_from // self.resolution), t_to // self.resolution)
+        stats = [0, 0, 0, 0]
+        for (slot, counts) in zip(self.slots, self.counts):
+            if slot is not None and first <= slot < last:
+                stats = list(map(operator.add, stats, counts))
+        return stats
+
+class LogFollower:
+    """Daemon: Follow the Postfix mail log and answer queries of checks.
+
+    Counts classified lines as they are appended to the log into ring
+    buffers (by second for the last hour, by minute for the last week) and
+    serves the stats of arbitrary time frames over a UNIX socket.
+    """
+
+    def __init__(self, postfix, path):
+        self.postfix = postfix
+        self.path    = path
+        self.seconds = RingBuffer(3600, 1)
+        self.minutes = RingBuffer(7 * 24 * 60 + 60, 60)
+
+    def prefill(self):
+        # Fill the minute buffer for the last week from the rotation chain,
+        # returns the offset following starts at
+        postfix = self.postfix
+        buckets = {}
+        (inode, offset) = postfix.fillBuckets(
+                postfix.toStamp(postfix.now - FRAMES['week']), buckets)
+        for (key, counts) in buckets.items():
+            t_minute = calendar.timegm(time.strptime(key, BUCKET_FMT))
+            for (idx, count) in enumerate(counts):
+                self.minutes.add(t_minute, idx, count)
+        if postfix.indexfile:
+            postfix.saveIndex()
+        # the second buffer covers lines from the next minute on
+        self.t_started = (postfix.t_now // 60 + 1) * 60
+        return offset
+
+    def follow(self, f, rest):
+        # Count complete lines appended to f, returns the incomplete rest
+        postfix = self.postfix
+        data = rest + f.read()
+        nl = data.rfind(b'\n')
+        if nl == -1:
+            return data
+        chunk = data[:nl + 1]
+        for m in LINE_RE.finditer(chunk):
+            sol = chunk.rfind(b'\n', 0, m.start()) + 1
+            try:
+                t_line = postfix.parseTime(chunk[sol:sol + 32])
+            except ValueError:
+                postfix.skipLine(chunk, sol)
+                continue
+            self.seconds.add(t_line, m.lastindex - 1)
+            self.minutes.add(t_line, m.lastindex - 1)
+        return data[nl + 1:]
+
+    def reopen(self, f):
+        # Return the current log file once logrotate moved f away, f
+        # itself rewound if it was truncated, None if f is still current
+        try:
+            stat = os.stat(self.postfix.logfile)
+        except OSError:
+            return None
+        if stat.st_ino != os.fstat(f.fileno()).st_ino:
+            return open(self.postfix.logfile, 'rb')
+        if stat.st_size < f.tell():
+            f.seek(0)
+            return f
+        return None
+
+    def query(self, t_splits):
+        # Return stats of the time frames starting at t_splits, from the
+        # second buffer where it covers the time frame, else by minute
+        t_now = self.postfix.t_now
+        t_border = max(self.t_started, (t_now - 3600) // 60 * 60 + 60)
+        stats = []
+        for t in t_splits:
+            if t >= t_border:
+                stats.append(self.seconds.sum(t, t_now + 1))
+            else:
+                stats.append(list(map(operator.add,
+                        self.minutes.sum(t // 60 * 60, t_border),
+                        self.seconds.sum(t_border, t_now + 1))))
+        return stats
+
+    def answer(self, conn):
+        conn.settimeout(SOCKET_TIMEOUT)
+        try:
+            t_splits = json.loads(conn.makefile('rb').readline().decode('ascii'))
+            conn.sendall(json.dumps(self.query(t_splits)).encode('ascii')
+                         + b'\n')
+        except (OSError, ValueError, TypeError):
+            pass
+        finally:
+            conn.close()
+
+    def run(self):
+        import selectors
+        import signal
+        import socket
+        postfix = self.postfix
+        offset = self.prefill()
+        f = open(postfix.logfile, 'rb')
+        f.seek(offset)
+        rest = b''
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen()
+        sel = selectors.DefaultSelector()
+        sel.register(server, selectors.EVENT_READ)
+        # exit through the finally clause below when stopped
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        try:
+            while True:
+                events = sel.select(timeout=1)
+                postfix.now = datetime.now().replace(microsecond=0)
+                postfix.t_now = postfix.toStamp(postfix.now)
+                rest = self.follow(f, rest)
+                current = self.reopen(f)
+                if current is f:
+                    # truncated, the incomplete line is gone with it
+                    rest = self.follow(f, b'')
+                elif current:
+                    # finish the rotated file before switching over
+                    rest = self.follow(f, rest)
+                    f.close()
+                    (f, rest) = (current, b'')
+                    rest = self.follow(f, rest)
+                if events:
+                    (conn, addr) = server.accept()
+                    self.answer(conn)
+        finally:
+            server.close()
+            os.unlink(self.path)
 
 class LoadSummary(nagiosplugin.Summary):
     def __init__(self, mode):
         self.mode = mode
 
     def ok(self, results):
-        return 'messages per {}: {} sent, {} received, {} greylisted, {} rejected'.format(
-                    self.mode,
-                    results['sent'].metric,
-                    results['received'].metric,
-                    results['greylisted'].metric,
-                    results['rejected'].metric)
+        if self.mode != 'all':
+            return 'messages per {}: {} sent, {} received, {} greylisted, {} rejected'.format(
+                        self.mode,
+                        results['sent'].metric,
+                        results['received'].metric,
+                        results['greylisted'].metric,
+                        results['rejected'].metric)
+        return '; '.join('messages per {}: {} sent, {} received, {} greylisted, {} rejected'.format(
+                    frame,
+                    results['sent_' + frame].metric,
+                    results['received_' + frame].metric,
+                    results['greylisted_' + frame].metric,
+                    results['rejected_' + frame].metric) for frame in FRAMES)
 
     problem = ok
 
+    def verbose(self, results):
+        msgs = super().verbose(results)
+        for category in ('reason', 'relay', 'domain'):
+            top = ['{} {}'.format(result.metric.name[len(category) + 1:],
+                                  result.metric.value)
+                   for result in results
+                   if result.metric.context == 'breakdown' and
+                      result.metric.name.startswith(category + '_')]
+            if top:
+                msgs.append('top {}: {}'.format(category, ', '.join(top)))
+        return msgs + verboseTimings(results)
+
+def getRange(ranges, name, frame):
+    # Return the most specific of repeated RANGE, FRAME=RANGE or
+    # NAME_FRAME=RANGE arguments for a metric of --mode all
+    found = ''
+    for value in ranges:
+        (key, sep, r) = value.rpartition('=')
+        if key in ('', frame, '{}_{}'.format(name, frame)):
+            if key or not found:
+                found = r
+    return found
+
+def expandLogfiles(patterns):
+    # Return the log files of repeated --logfile arguments, which may be
+    # glob patterns. Rotated files matched by a pattern are left out, they
+    # are read as part of the rotation chain of their log file.
+    import glob
+    logfiles = []
+    for pattern in patterns:
+        paths = sorted(glob.glob(pattern))
+        if not glob.has_magic(pattern):
+            # missing files are reported when they are read
+            paths = paths or [pattern]
+        for path in paths:
+            if path in logfiles:
+                continue
+            if path == pattern or not ROTATED_RE.search(path):
+                logfiles.append(path)
+    return logfiles
+
+def instanceNames(logfiles):
+    # Return perfdata labels of the instances logging to logfiles: the file
+    # names without .log (postfix-in.log: postfix-in), or the whole paths
+    # if file names are ambiguous
+    names = [os.path.basename(path) for path in logfiles]
+    names = [name[:-4] if name.endswith('.log') else name for name in names]
+    if len(set(names)) < len(names):
+        names = [path.strip('/') for path in logfiles]
+    return [LABEL_RE.sub('_', name) for name in names]
+
 def main():
     argp = argparse.ArgumentParser(description=__doc__)
-    argp.add_argument('-l', '--logfile', metavar='FILE', default='/var/log/mail.log',
-                help='Postfix logfile (default: /var/log/mail.log)')
+    argp.add_argument('-l', '--logfile', metavar='FILE', action='append',
+                help='Postfix logfile, repeatable and may be a glob pattern \
+                      for several instances, e.g. "/var/log/postfix-*.log" \
+                      (default: /var/log/mail.log)')
     argp.add_argument('-m', '--mode', metavar='MODE', default='minute',
-                help='mode to check: minute, hour, day, week \
-                      (default: minute)')
-    argp.add_argument('-w', '--warning', metavar='RANGE', default='',
-                help='return warning if value is outside RANGE')
-    argp.add_argument('-c', '--critical', metavar='RANGE', default='',
-                help='return critical if value is outside RANGE')
+                help='mode to check: minute, hour, day, week or all \
+                      time frames at once (default: minute)')
+    argp.add_argument('-w', '--warning', metavar='RANGE', action='append',
+                default=[],
+                help='return warning if value is outside RANGE, for mode \
+                      all also FRAME=RANGE or COUNTER_FRAME=RANGE \
+                      (e.g. day=1000 or rejected_hour=50), repeatable')
+    argp.add_argument('-c', '--critical', metavar='RANGE', action='append',
+                default=[],
+                help='return critical if value is outside RANGE, see \
+                      --warning')
+    argp.add_argument('-s', '--statefile', metavar='FILE',
+                help='keep a checkpoint in FILE and only parse new log lines \
+                      on each run (default: parse the whole time frame)')
+    argp.add_argument('-i', '--indexfile', metavar='FILE',
+                help='keep per-minute counters of compressed rotated logs \
+                      in FILE, so they are only inflated once')
+    argp.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                help='parse large logs, or several log files, in up to N \
+                      processes (default: 1)')
+    argp.add_argument('-t', '--top', metavar='K', type=int, default=0,
+                help='report the K most frequent reject reasons, relays and \
+                      recipient domains of the (longest) time frame')
+    argp.add_argument('-v', '--verbose', action='count', default=0,
+                help='increase output verbosity (use up to 3 times)')
+    argp.add_argument('-T', '--timings', action='store_true',
+                help='report wall time of the check phases and the amount \
+                      of log data scanned as perfdata')
+    argp.add_argument('--profile', metavar='FILE',
+                help='dump cProfile stats of the check to FILE')
+    argp.add_argument('-S', '--socket', metavar='FILE',
+                help='query the log follower daemon listening on UNIX \
+                      socket FILE, parse the logs if it is not reachable')
+    argp.add_argument('-d', '--daemon', action='store_true',
+                help='run as log follower daemon serving checks on --socket')
     args = argp.parse_args()
 
+    logfiles = expandLogfiles(args.logfile or ['/var/log/mail.log'])
+    if not logfiles:
+        argp.error('no log files match {}'.format(', '.join(args.logfile)))
+    if args.socket and len(logfiles) > 1:
+        argp.error('--socket supports a single --logfile')
+
+    if args.daemon:
+        if not args.socket:
+            argp.error('--daemon requires --socket')
+        postfix = Postfix(logfile=logfiles[0], mode='all',
+                          indexfile=args.indexfile)
+        if args.indexfile:
+            postfix.index = postfix.loadJson(args.indexfile) or {}
+        LogFollower(postfix, args.socket).run()
+        return
+
+    if args.mode == 'all':
+        contexts = [nagiosplugin.ScalarContext('{}_{}'.format(name, frame),
+                        getRange(args.warning, name, frame),
+                        getRange(args.critical, name, frame))
+                    for frame in FRAMES for name in COUNTERS]
+    else:
+        contexts = [nagiosplugin.ScalarContext(args.mode,
+                        getRange(args.warning, None, args.mode),
+                        getRange(args.critical, None, args.mode))]
+
     check = nagiosplugin.Check(
-                Postfix(logfile=args.logfile, mode=args.mode),
-                nagiosplugin.ScalarContext(args.mode, args.warning,
-                    args.critical),
+                Postfix(logfile=logfiles, mode=args.mode,
+                    statefile=args.statefile, indexfile=args.indexfile,
+                    jobs=args.jobs, socket=args.socket, top=args.top,
+                    timings=Timings(args.timings, args.profile)),
+                *contexts,
+                nagiosplugin.ScalarContext('breakdown'),
+                nagiosplugin.ScalarContext('instance'),
+                nagiosplugin.ScalarContext('timings'),
                 LoadSummary(args.mode))
-    check.main(timeout=120)
+    check.main(verbose=args.verbose, timeout=120)
 
 if __name__ == '__main__':
     main()
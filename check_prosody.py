@@ -8,11 +8,58 @@
 # (c) 2018 doobry@systemli.org
 
 import argparse
+import functools
 import nagiosplugin
 import os
 import re
-import requests
-import telnetlib
+import time
+import urllib.parse
+
+from checkutils import Timings, loadJson, saveJson, verboseTimings
+
+# Console commands of each mode with the end markers of their replies
+COMMANDS = {
+    'c2s':      [("c2s:show_secure()",
+                  rb"Total: \d+ secure client connections"),
+                 ("c2s:show_insecure()",
+                  rb"Total: \d+ insecure client connections")],
+    's2s':      [("s2s:show()", rb"\d+ outgoing, \d+ incoming connections")],
+    'presence': [("c2s:show()", rb"Total: \d+ clients")],
+    'uptime':   [("server:uptime()",
+                  rb"This server has been running for .* minutes? \(.*\)")],
+}
+# An end marker only counts as the summary line of a reply, session lines
+# are indented further
+MARKER_FMT = rb"\| (?:OK: )?(?:%s)\s*$"
+CONSOLE_MODES = ('c2s', 's2s', 'presence', 'uptime')
+# Presence states counted from c2s:show() output
+PRESENCE_STATES = ('available', 'chat', 'away', 'xa', 'dnd')
+PRESENCE_RE = re.compile(rb"[-\]] (.*?)\(\d+\)")
+# Maximum length of a console line
+LINE_LIMIT = 1024 * 1024
+# Metrics of each mode
+METRICS = {
+    'c2s':      ('c2s_secure', 'c2s_insecure', 'c2s_all'),
+    's2s':      ('s2s_outgoing', 's2s_incoming'),
+    'presence': ('available', 'chat', 'away', 'xa', 'dnd'),
+    'uptime':   ('uptime', ),
+    'users':    ('users', ),
+}
+# Characters not allowed in per vhost perfdata labels
+LABEL_RE = re.compile(r'[^\w.@-]+')
+# OpenMetrics families of each mode, mapped to metric names, with the
+# labels a sample must have to be counted (mod_http_openmetrics)
+FAMILIES = {
+    'c2s':      [('c2s_all', b'prosody_mod_c2s__connections', {'type': 'c2s'})],
+    's2s':      [('s2s_outgoing', b'prosody_mod_s2s__connections_outbound', {}),
+                 ('s2s_incoming', b'prosody_mod_s2s__connections_inbound', {})],
+    'uptime':   [('uptime', b'process_start_time_seconds', {})],
+}
+SAMPLE_RE = re.compile(rb'([a-zA-Z_:][\w:]*)(?:\{(.*)\})? (\S+)')
+SAMPLE_LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+# Accounts per vhost in Prosody's SQL storage
+ACCOUNTS_SQL = "SELECT host, COUNT(DISTINCT user) FROM prosody " \
+               "WHERE store = 'accounts' GROUP BY host"
 
 class Prosody(nagiosplugin.Resource):
     """Domain model: Get metrics from Prosody XMPP server.
@@ -20,143 +67,374 @@ class Prosody(nagiosplugin.Resource):
     Determines different metrics from Prosody XMPP server.
     """
 
-    def __init__(self, host='localhost', port=5582, mode='users'):
-        self.host = host
-        self.port = port
-        self.mode = mode
+    def __init__(self, host='localhost', port=5582, mode='users', timeout=5,
+                 datadir='/var/lib/prosody', database=None, cachefile=None,
+                 source='console', url='http://localhost:5280/metrics',
+                 timings=None):
+        self.host      = host
+        self.port      = port
+        self.mode      = mode
+        self.timeout   = timeout
+        self.datadir   = datadir
+        self.database  = database
+        self.cachefile = cachefile
+        self.source    = source
+        self.url       = url
+        self.timings   = timings or Timings()
+        self.http      = None
 
-    def listDirs(self, directory):
-        for x in os.listdir(directory):
-            if os.path.isdir(os.path.join(directory, x)):
-                yield x
+    async def session(self, commands, handlers):
+        # Send console commands in one go (pipelined) and read the replies
+        # line by line as they arrive, until the end marker of each reply.
+        # Lines are passed to the handler of their command (if any) and
+        # dropped, only the line with the end marker is kept.
+        import asyncio
+        loop = asyncio.get_running_loop()
+        with self.timings.phase('connect'):
+            (reader, writer) = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port,
+                                            limit=LINE_LIMIT), self.timeout)
+        deadline = loop.time() + self.timeout
+        try:
+            with self.timings.phase('fetch'):
+                writer.write(b"".join(command.encode('ascii') + b"\n"
+                                      for (command, marker) in commands))
+                await writer.drain()
+                replies = []
+                for (i, (command, marker)) in enumerate(commands):
+                    marker = re.compile(MARKER_FMT % marker)
+                    while True:
+                        try:
+                            line = await asyncio.wait_for(reader.readline(),
+                                    deadline - loop.time())
+                        except ValueError:
+                            raise nagiosplugin.CheckError(
+                                'console line longer than {} bytes in reply '
+                                'to {}'.format(LINE_LIMIT, command))
+                        if self.timings.enabled:
+                            self.timings.count('bytes', len(line))
+                            self.timings.count('lines', 1)
+                        if not line:
+                            raise nagiosplugin.CheckError(
+                                'console closed before reply to {}'.format(
+                                    command))
+                        if marker.match(line):
+                            replies.append(line.decode('utf-8', 'replace'))
+                            break
+                        if i in handlers:
+                            handlers[i](line)
+                writer.write("quit".encode('ascii') + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+        return replies
 
-    def listFiles(self, directory):
-        for x in os.listdir(directory):
-            if os.path.isfile(os.path.join(directory, x)):
-                yield x
+    def console(self, commands, handlers={}):
+        # Run a console session, returns the end marker line of each reply
+        import asyncio
+        try:
+            return asyncio.run(self.session(commands, handlers))
+        except asyncio.TimeoutError:
+            raise nagiosplugin.CheckError(
+                'no reply from console {}:{} within {}s'.format(
+                    self.host, self.port, self.timeout))
+        except OSError as e:
+            raise nagiosplugin.CheckError(
+                'console {}:{}: {}'.format(self.host, self.port, e))
 
-    def getC2s(self):
-        c2s_conn_re = re.compile(r"Total:\s(\d+)\s")
-        tn = telnetlib.Telnet(self.host, self.port)
+    def openMetrics(self, families):
+        # Fetch the OpenMetrics endpoint and sum up the samples of the
+        # wanted families. The samples of a family are contiguous, so
+        # reading stops once all of them have passed.
+        import requests
+        if self.http is None:
+            self.http = requests.Session()
+        wanted = {family for (name, family, labels) in families}
+        samples = {family: [] for family in wanted}
+        try:
+            with self.timings.phase('connect'):
+                r = self.http.get(self.url, stream=True, timeout=self.timeout)
+            with r, self.timings.phase('fetch'):
+                r.raise_for_status()
+                for line in r.iter_lines():
+                    if self.timings.enabled:
+                        self.timings.count('bytes', len(line) + 1)
+                        self.timings.count('lines', 1)
+                    m = SAMPLE_RE.match(line)
+                    if not m:
+                        continue
+                    if m.group(1) in wanted:
+                        labels = dict(SAMPLE_LABEL_RE.findall(
+                                (m.group(2) or b'').decode('utf-8', 'replace')))
+                        samples[m.group(1)].append((labels, float(m.group(3))))
+                    elif all(samples.values()):
+                        break
+        except requests.exceptions.RequestException as e:
+            raise nagiosplugin.CheckError(
+                'cannot fetch {}: {}'.format(self.url, e))
+        except ValueError:
+            raise nagiosplugin.CheckError(
+                'invalid sample at {}: {}'.format(self.url, line))
+        values = {}
+        for (name, family, labels) in families:
+            if not samples[family]:
+                raise nagiosplugin.CheckError('no {} at {}'.format(
+                        family.decode('ascii'), self.url))
+            values[name] = sum(value for (l, value) in samples[family]
+                               if labels.items() <= l.items())
+        return values
 
-        tn.write("c2s:show_secure()".encode('ascii') + b"\n")
-        tn_res = tn.read_until(b"secure client connections", 5)
-        parsed = c2s_conn_re.findall(tn_res.decode('utf-8'))
-        c_sec = int(parsed[0])
+    def fromOpenMetrics(self, modes):
+        # Map OpenMetrics families onto the values of console modes. There
+        # is no split of c2s connections into secure and insecure ones.
+        values = self.openMetrics([family for mode in modes
+                                   for family in FAMILIES[mode]])
+        result = {}
+        if 'c2s' in modes:
+            result['c2s'] = (None, None, int(values['c2s_all']))
+        if 's2s' in modes:
+            result['s2s'] = (int(values['s2s_outgoing']),
+                             int(values['s2s_incoming']))
+        if 'uptime' in modes:
+            result['uptime'] = (time.time() - values['uptime']) / 86400
+        return result
 
-        tn.write("c2s:show_insecure()".encode('ascii') + b"\n")
-        tn_res = tn.read_until(b"insecure client connections", 5)
-        parsed = c2s_conn_re.findall(tn_res.decode('utf-8'))
-        c_insec = int(parsed[0])
+    def countPresence(self, states, line):
+        for state in PRESENCE_RE.findall(line):
+            state = state.decode('utf-8', 'replace')
+            if state in states:
+                states[state] += 1
 
-        tn.write("quit".encode('ascii') + b"\n")
+    def parseC2s(self, res_sec, res_insec):
+        c2s_conn_re = re.compile(r"Total:\s(\d+)\s")
+        c_sec = int(c2s_conn_re.findall(res_sec)[0])
+        c_insec = int(c2s_conn_re.findall(res_insec)[0])
         c_all = c_sec + c_insec
         return (c_sec, c_insec, c_all)
 
-    def getS2s(self):
+    def parseS2s(self, res):
         s2s_conn_re = re.compile(r"(\d+) outgoing, (\d+) incoming")
-        tn = telnetlib.Telnet(self.host, self.port)
-        tn.write("s2s:show()".encode('ascii') + b"\n")
-        tn_res = tn.read_until(b"incoming connections", 5)
-        parsed = s2s_conn_re.findall(tn_res.decode('utf-8'))
-        tn.write("quit".encode('ascii') + b"\n")
+        parsed = s2s_conn_re.findall(res)
         return (int(parsed[0][0]), int(parsed[0][1]))
 
-    def getPresence(self):
-        c2s_pres_re = re.compile(r"[-\]] (.*?)\(\d+\)")
-        tn = telnetlib.Telnet(self.host, self.port)
-        tn.write("c2s:show()".encode('ascii') + b"\n")
-        tn_res = tn.read_until(b"clients", 5)
-        parsed = c2s_pres_re.findall(tn_res.decode('utf-8'))
-        tn.write("quit".encode('ascii') + b"\n")
-        return (parsed.count("available"), parsed.count("chat"), parsed.count("away"), parsed.count("xa"), parsed.count("dnd"))
+    def parsePresence(self, states):
+        return tuple(states[state] for state in PRESENCE_STATES)
 
-    def getUptime(self):
+    def parseUptime(self, res):
         uptime_re = re.compile(r"\d+")
-        tn = telnetlib.Telnet(self.host, self.port)
-        tn.write("server:uptime()".encode('ascii') + b"\n")
-        tn_res = tn.read_until(b"minutes (", 5)
-        parsed = uptime_re.findall(tn_res.decode('utf-8'))
-        tn.write("quit".encode('ascii') + b"\n")
+        parsed = uptime_re.findall(res)
         uptime = float(parsed[0]) + float(parsed[1])/24 + \
                  float(parsed[2])/60/24
         return uptime
 
+    def getC2s(self):
+        if self.source == 'openmetrics':
+            return self.fromOpenMetrics(['c2s'])['c2s']
+        replies = self.console(COMMANDS['c2s'])
+        with self.timings.phase('parse'):
+            return self.parseC2s(*replies)
+
+    def getS2s(self):
+        if self.source == 'openmetrics':
+            return self.fromOpenMetrics(['s2s'])['s2s']
+        replies = self.console(COMMANDS['s2s'])
+        with self.timings.phase('parse'):
+            return self.parseS2s(*replies)
+
+    def getPresence(self):
+        # c2s:show() lists every session, count them as they arrive
+        states = dict.fromkeys(PRESENCE_STATES, 0)
+        self.console(COMMANDS['presence'],
+                     {0: functools.partial(self.countPresence, states)})
+        return self.parsePresence(states)
+
+    def getUptime(self):
+        if self.source == 'openmetrics':
+            return self.fromOpenMetrics(['uptime'])['uptime']
+        replies = self.console(COMMANDS['uptime'])
+        with self.timings.phase('parse'):
+            return self.parseUptime(*replies)
+
+    def loadCache(self):
+        cache = loadJson(self.cachefile) or {}
+        if cache.get('datadir') != self.datadir:
+            return {}
+        return cache.get('accounts', {})
+
+    def saveCache(self, accounts):
+        saveJson(self.cachefile, {'datadir': self.datadir,
+                                  'accounts': accounts})
+
+    def countAccounts(self, account_dir):
+        # Account files are <user>.dat, the file type comes with the
+        # directory entry, so no stat per account is needed
+        with os.scandir(account_dir) as entries:
+            return sum(1 for entry in entries
+                       if entry.name.endswith('.dat') and entry.is_file())
+
+    def getUsersInternal(self):
+        # Prosody's internal (file) storage keeps one accounts directory
+        # per vhost, with the vhost name percent-encoded. Directories whose
+        # mtime didn't change since the last run aren't enumerated again.
+        cache = self.loadCache() if self.cachefile else {}
+        accounts = {}
+        users = {}
+        try:
+            entries = list(os.scandir(self.datadir))
+        except OSError as e:
+            raise nagiosplugin.CheckError(
+                'cannot read data directory {}: {}'.format(self.datadir, e))
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            account_dir = os.path.join(entry.path, 'accounts')
+            try:
+                mtime = os.stat(account_dir).st_mtime_ns
+            except OSError:
+                continue
+            if account_dir in cache and cache[account_dir][0] == mtime:
+                count = cache[account_dir][1]
+            else:
+                count = self.countAccounts(account_dir)
+            accounts[account_dir] = [mtime, count]
+            users[urllib.parse.unquote(entry.name)] = count
+        if self.cachefile and accounts != cache:
+            self.saveCache(accounts)
+        return users
+
+    def getUsersSql(self):
+        # Prosody's SQL storage with the SQLite driver, opened read-only
+        import sqlite3
+        try:
+            db = sqlite3.connect('file:{}?mode=ro'.format(
+                                 urllib.parse.quote(self.database)), uri=True)
+            try:
+                return dict(db.execute(ACCOUNTS_SQL))
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            raise nagiosplugin.CheckError(
+                'cannot read database {}: {}'.format(self.database, e))
+
     def getUsers(self):
-        base_dir = "/var/lib/prosody"
-        account = 0
-        if os.path.isdir(base_dir):
-            vhosts = self.listDirs(base_dir)
-            for vhost in vhosts:
-                account_dir = os.path.join(base_dir, vhost, "accounts")
-                if os.path.isdir(account_dir):
-                    vhost = vhost.replace("%2e",".")
-                    accounts = len(list(self.listFiles(account_dir)))
-        return accounts
+        # Registered users per vhost
+        with self.timings.phase('users'):
+            if self.database:
+                return self.getUsersSql()
+            return self.getUsersInternal()
+
+    def getAll(self):
+        if self.source == 'openmetrics':
+            # presence isn't exported, it still needs the console
+            values = self.fromOpenMetrics(list(FAMILIES))
+            values['presence'] = self.getPresence()
+            values['users'] = self.getUsers()
+            return values
+        # Issue the commands of all console modes over a single session
+        commands = [command for mode in CONSOLE_MODES
+                    for command in COMMANDS[mode]]
+        states = dict.fromkeys(PRESENCE_STATES, 0)
+        handlers = {commands.index(COMMANDS['presence'][0]):
+                    functools.partial(self.countPresence, states)}
+        replies = self.console(commands, handlers)
+        parsers = {'c2s': self.parseC2s, 's2s': self.parseS2s,
+                   'uptime': self.parseUptime}
+        values = {}
+        with self.timings.phase('parse'):
+            for mode in CONSOLE_MODES:
+                count = len(COMMANDS[mode])
+                (mode_replies, replies) = (replies[:count], replies[count:])
+                if mode == 'presence':
+                    values[mode] = self.parsePresence(states)
+                else:
+                    values[mode] = parsers[mode](*mode_replies)
+        values['users'] = self.getUsers()
+        return values
 
     def probe(self):
-        if self.mode == 'c2s':
-            (c_sec, c_insec, c_all) = self.getC2s()
-            return [nagiosplugin.Metric('c2s_secure', c_sec, min=0,
-                                    context='c2s'),
-                    nagiosplugin.Metric('c2s_insecure', c_insec, min=0,
-                                    context='c2s'),
-                    nagiosplugin.Metric('c2s_all', c_all, min=0,
-                                    context='c2s')]
-        if self.mode == 's2s':
-            (c_out, c_in) = self.getS2s()
-            return [nagiosplugin.Metric('s2s_outgoing', c_out, min=0,
-                                    context='s2s'),
-                    nagiosplugin.Metric('s2s_incoming', c_in, min=0,
-                                    context='s2s')]
-        if self.mode == 'presence':
-            (avail, chat, away, xa, dnd) = self.getPresence()
-            return [nagiosplugin.Metric('available', avail, min=0,
-                                    context='presence'),
-                    nagiosplugin.Metric('chat', chat, min=0,
-                                    context='presence'),
-                    nagiosplugin.Metric('away', xa, min=0,
-                                    context='presence'),
-                    nagiosplugin.Metric('xa', dnd, min=0,
-                                    context='presence'),
-                    nagiosplugin.Metric('dnd', away, min=0,
-                                    context='presence')]
-        if self.mode == 'uptime':
-            uptime = self.getUptime()
-            return [nagiosplugin.Metric('uptime', uptime, min=0,
-                                    context='uptime')]
-        if self.mode == 'users':
-            users = self.getUsers()
-            return [nagiosplugin.Metric('users', users, min=0,
-                                    context='users')]
+        return self.timings.run(self.getMetrics) + self.timings.metrics()
+
+    def getMetrics(self):
+        getters = {'c2s': self.getC2s, 's2s': self.getS2s,
+                   'presence': self.getPresence, 'uptime': self.getUptime,
+                   'users': self.getUsers}
+        if self.mode == 'all':
+            values = self.getAll()
+        else:
+            values = {self.mode: getters[self.mode]()}
+
+        metrics = []
+        if 'users' in values:
+            vhosts = values['users']
+            values['users'] = sum(vhosts.values())
+            for (vhost, count) in sorted(vhosts.items()):
+                metrics.append(nagiosplugin.Metric(
+                        'users_' + LABEL_RE.sub('_', vhost), count, min=0,
+                        context='vhost'))
+        for (mode, value) in values.items():
+            if mode == 'uptime' or mode == 'users':
+                value = (value, )
+            for (name, v) in zip(METRICS[mode], value):
+                if v is None:
+                    continue
+                context = name if self.mode == 'all' else mode
+                metrics.append(nagiosplugin.Metric(name, v, min=0,
+                                                   context=context))
+        return metrics
 
 class LoadSummary(nagiosplugin.Summary):
     def __init__(self, mode='users'):
         self.mode = mode
 
-    def ok(self, results):
-        if self.mode == 'c2s':
+    def summary(self, mode, results):
+        if mode == 'c2s' and 'c2s_secure' not in results:
+            return 'Client to Server connections: {} total'.format(
+                        results['c2s_all'].metric)
+        if mode == 'c2s':
             return 'Client to Server connections: {} secure, {} insecure, {} total'.format(
                         results['c2s_secure'].metric,
                         results['c2s_insecure'].metric,
                         results['c2s_all'].metric)
-        if self.mode == 's2s':
+        if mode == 's2s':
             return 'Server to Server connections: {} outgoing, {} incoming'.format(
                         results['s2s_outgoing'].metric,
                         results['s2s_incoming'].metric)
-        if self.mode == 'presence':
+        if mode == 'presence':
             return 'Client presence: {} available, {} chat, {} away, {} xa, {} dnd'.format(
                         results['available'].metric,
                         results['chat'].metric,
                         results['away'].metric,
                         results['xa'].metric,
                         results['dnd'].metric)
-        if self.mode == 'uptime':
+        if mode == 'uptime':
             return 'Uptime: {} days'.format(results['uptime'].metric)
-        if self.mode == 'users':
+        if mode == 'users':
             return 'Registered users: {}'.format(results['users'].metric)
 
-    problem = ok
+    def ok(self, results):
+        if self.mode == 'all':
+            return '; '.join(self.summary(mode, results) for mode in METRICS)
+        return self.summary(self.mode, results)
+
+    def problem(self, results):
+        # an error occurred instead of getting metrics
+        if results.first_significant.metric is None:
+            return super().problem(results)
+        return self.ok(results)
+
+    def verbose(self, results):
+        return super().verbose(results) + verboseTimings(results)
+
+def getRange(ranges, name, mode):
+    # Return the most specific of repeated RANGE, MODE=RANGE or
+    # METRIC=RANGE arguments for a metric of --mode all
+    found = ''
+    for value in ranges:
+        (key, sep, r) = value.rpartition('=')
+        if key in ('', mode, name):
+            if key or not found:
+                found = r
+    return found
 
 def main():
     argp = argparse.ArgumentParser(description=__doc__)
@@ -166,20 +444,70 @@ def main():
     argp.add_argument('-p', '--port', metavar='PORT', default='5582',
                 help='port of the Prosody XMPP server (default: 5582)')
     argp.add_argument('-m', '--mode', metavar='MODE', default='users',
-                help='mode to check: c2s, s2s, presence, uptime, users \
-                      (default: users)')
-    argp.add_argument('-w', '--warning', metavar='RANGE', default='',
-                help='return warning if value is outside RANGE')
-    argp.add_argument('-c', '--critical', metavar='RANGE', default='',
-                help='return critical if value is outside RANGE')
+                help='mode to check: c2s, s2s, presence, uptime, users or \
+                      all of them at once (default: users)')
+    argp.add_argument('-d', '--datadir', metavar='DIR',
+                default='/var/lib/prosody',
+                help='data directory of Prosody\'s internal storage for mode \
+                      users (default: /var/lib/prosody)')
+    argp.add_argument('-D', '--database', metavar='FILE',
+                help='count users in the SQLite database of Prosody\'s SQL \
+                      storage instead of the data directory')
+    argp.add_argument('-C', '--cachefile', metavar='FILE',
+                help='file to cache account counts per vhost in, vhosts \
+                      whose accounts directory is unchanged are not counted \
+                      again')
+    argp.add_argument('-s', '--source', choices=('console', 'openmetrics'),
+                default='console',
+                help='get c2s, s2s and uptime from the telnet console or \
+                      from mod_http_openmetrics (default: console)')
+    argp.add_argument('-u', '--url', metavar='URL',
+                default='http://localhost:5280/metrics',
+                help='URL of the OpenMetrics endpoint \
+                      (default: http://localhost:5280/metrics)')
+    argp.add_argument('-t', '--timeout', metavar='SECONDS', type=float,
+                default=5,
+                help='deadline to connect and to read all console or HTTP \
+                      replies (default: 5)')
+    argp.add_argument('-v', '--verbose', action='count', default=0,
+                help='increase output verbosity (use up to 3 times)')
+    argp.add_argument('-T', '--timings', action='store_true',
+                help='report wall time of the check phases and the amount \
+                      of data read as perfdata')
+    argp.add_argument('--profile', metavar='FILE',
+                help='dump cProfile stats of the check to FILE')
+    argp.add_argument('-w', '--warning', metavar='RANGE', action='append',
+                default=[],
+                help='return warning if value is outside RANGE, for mode \
+                      all also MODE=RANGE or METRIC=RANGE (e.g. \
+                      c2s=1000 or dnd=50), repeatable')
+    argp.add_argument('-c', '--critical', metavar='RANGE', action='append',
+                default=[],
+                help='return critical if value is outside RANGE, see \
+                      --warning')
     args = argp.parse_args()
 
+    if args.mode == 'all':
+        contexts = [nagiosplugin.ScalarContext(name,
+                        getRange(args.warning, name, mode),
+                        getRange(args.critical, name, mode))
+                    for mode in METRICS for name in METRICS[mode]]
+    else:
+        contexts = [nagiosplugin.ScalarContext(args.mode,
+                        getRange(args.warning, None, args.mode),
+                        getRange(args.critical, None, args.mode))]
+
     check = nagiosplugin.Check(
-                Prosody(host=args.hostname, port=args.port, mode=args.mode),
-                nagiosplugin.ScalarContext(args.mode, args.warning,
-                    args.critical),
+                Prosody(host=args.hostname, port=args.port, mode=args.mode,
+                    timeout=args.timeout, datadir=args.datadir,
+                    database=args.database, cachefile=args.cachefile,
+                    source=args.source, url=args.url,
+                    timings=Timings(args.timings, args.profile)),
+                *contexts,
+                nagiosplugin.ScalarContext('timings'),
+                nagiosplugin.ScalarContext('vhost'),
                 LoadSummary(args.mode))
-    check.main()
+    check.main(verbose=args.verbose)
 
 if __name__ == '__main__':
     main()
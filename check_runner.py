@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+
+# check_runner.py - Run the check scripts in a resident, preloaded process
+#
+# Licensed under the GNU GPLv3
+
+"""Run check_*.py scripts without interpreter startup and imports.
+
+With --daemon, the runner imports all check scripts and the modules they
+load lazily, then waits for requests on a UNIX socket. For every request
+it forks a child that runs the check's main() with the client's stdout,
+stderr and working directory, so output and exit code are the same as
+running the script itself.
+
+Without --daemon it is the client:
+
+    check_runner.py -S /run/checks.sock check_postfix.py -m hour -w 100
+
+If the runner doesn't answer, the client runs the script directly.
+"""
+
+import json
+import os
+import socket
+import sys
+
+# Check scripts the runner may execute
+CHECKS = ('check_ethercalc', 'check_etherpad', 'check_postfix',
+          'check_prosody')
+# Modules the check scripts import lazily
+PRELOAD = ('asyncio', 'codecs', 'concurrent.futures', 'email.utils', 'gzip',
+           'heapq', 'lzma', 'multiprocessing', 'requests',
+           'requests.adapters', 'selectors', 'sqlite3', 'zlib')
+# Maximum size of a request
+MSG_SIZE = 64 * 1024
+
+def checkName(script):
+    # Return the module name of a check script given by name or path
+    name = os.path.basename(script)
+    if name.endswith('.py'):
+        name = name[:-3]
+    return name if name in CHECKS else None
+
+class Runner:
+    """Daemon: Keep the check scripts loaded and run checks on request."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def preload(self):
+        import importlib
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        for name in CHECKS + PRELOAD:
+            importlib.import_module(name)
+
+    def execute(self, conn):
+        # Run in the forked child: take over the client's stdout, stderr
+        # and working directory, run the check and send its exit code
+        import traceback
+        (msg, fds, flags, addr) = socket.recv_fds(conn, MSG_SIZE, 2)
+        request = json.loads(msg.decode('utf-8'))
+        os.dup2(fds[0], 1)
+        os.dup2(fds[1], 2)
+        for fd in fds:
+            os.close(fd)
+        os.chdir(request['cwd'])
+        sys.argv = request['argv']
+        try:
+            sys.modules[checkName(sys.argv[0])].main()
+            code = 0
+        except SystemExit as e:
+            # same exit codes as the interpreter
+            if e.code is None or isinstance(e.code, int):
+                code = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                code = 1
+        except BaseException as e:
+            # leave out the runner's own frame
+            traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+            code = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        conn.sendall('{}\n'.format(code).encode('ascii'))
+
+    def run(self):
+        import signal
+        self.preload()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # checks run with the runner's privileges, the socket is created
+        # accessible by its user only (not chmod after bind, which leaves
+        # a window to connect)
+        umask = os.umask(0o077)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(umask)
+        server.listen()
+        # forked children are reaped automatically
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+        while True:
+            (conn, addr) = server.accept()
+            if os.fork() == 0:
+                server.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                try:
+                    self.execute(conn)
+                finally:
+                    os._exit(0)
+            conn.close()
+
+def runCheck(path, script, args):
+    # Let the runner execute the check, returns its exit code or None if
+    # the runner isn't available
+    request = json.dumps({'cwd': os.getcwd(), 'argv': [script] + args})
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        socket.send_fds(sock, [request.encode('utf-8')], [1, 2])
+        reply = sock.makefile('rb').readline()
+    except OSError:
+        return None
+    finally:
+        sock.close()
+    return int(reply) if reply else None
+
+def main():
+    import argparse
+    argp = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    argp.add_argument('-S', '--socket', metavar='PATH', required=True,
+                help='UNIX socket of the runner')
+    argp.add_argument('-d', '--daemon', action='store_true',
+                help='run as resident runner answering on --socket')
+    argp.add_argument('check', nargs='?',
+                help='check script to run, e.g. check_postfix.py')
+    argp.add_argument('args', nargs=argparse.REMAINDER,
+                help='arguments of the check script')
+    args = argp.parse_args()
+
+    if args.daemon:
+        Runner(args.socket).run()
+        return
+    if not args.check or not checkName(args.check):
+        argp.error('check must be one of: {}'.format(', '.join(CHECKS)))
+    code = runCheck(args.socket, args.check, args.args)
+    if code is None:
+        # no runner, start the script the usual way
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              checkName(args.check) + '.py')
+        os.execv(sys.executable, [sys.executable, script] + args.args)
+    sys.exit(code)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# checkutils.py - Helpers shared by the check scripts
+#
+# Licensed under the GNU GPLv3
+
+"""Timings of the check phases, cache and state files and HTTP sessions,
+shared by the check_*.py scripts. They import it from their own
+directory, so it is installed next to them."""
+
+import contextlib
+import json
+import nagiosplugin
+import os
+import time
+
+class Timings:
+    """Wall time of the phases of a check and amounts of data processed.
+
+    Phases may be entered repeatedly, their times add up. Metrics are
+    only reported if enabled.
+    """
+
+    def __init__(self, enabled=False, profile=None):
+        self.enabled = enabled
+        self.profile = profile
+        self.times   = {}
+        self.counts  = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0) + \
+                               time.perf_counter() - start
+
+    def count(self, name, n):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def merge(self, other):
+        # Add the times and counts of other, e.g. of a worker process
+        for (name, value) in other.times.items():
+            self.times[name] = self.times.get(name, 0) + value
+        for (name, n) in other.counts.items():
+            self.count(name, n)
+
+    def run(self, func):
+        # Run func as phase 'total', under cProfile if a dump file is given
+        with self.phase('total'):
+            if not self.profile:
+                return func()
+            import cProfile
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(func)
+            finally:
+                profiler.dump_stats(self.profile)
+
+    def metrics(self):
+        if not self.enabled:
+            return []
+        return [nagiosplugin.Metric('time_' + name, round(value, 6), 's',
+                                    min=0, context='timings')
+                for (name, value) in self.times.items()] + \
+               [nagiosplugin.Metric(name, value, 'B' if name == 'bytes' else
+                                    None, min=0, context='timings')
+                for (name, value) in self.counts.items()]
+
+def verboseTimings(results):
+    # Return the long output line of the timings metrics, if there are any
+    timings = ['{} {}'.format(result.metric.name, result.metric.valueunit)
+               for result in results
+               if result.metric and result.metric.context == 'timings']
+    if timings:
+        return ['timings: {}'.format(', '.join(timings))]
+    return []
+
+def loadJson(path):
+    # Return the data of a cache or state file, None if it's missing or
+    # broken
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def saveJson(path, data):
+    # Write file atomically, concurrent checks may share it
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+def pooledSession(concurrency):
+    # Return a requests session keeping up to `concurrency` keep-alive
+    # connections, one per concurrent lookup
+    import requests
+    import requests.adapters
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session